@@ -0,0 +1,159 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from FHIR_pipeline import bundle_file_names, bundle_items, bundle_node_records, bundle_edge_records, unique_dates
+from NEO4J_Graph import node_record_batch, edge_record_batch
+
+# Loading of bundles with the neo4j async driver (see NEO4J_Graph.AsyncGraph), so the conversion of the bundles
+# and the writes to the database overlap and several writes are in flight at once.
+#
+# The bundles are converted in an executor (a pool of processes with processes > 1), at most max_pending bundles
+# ahead. The records are grouped into UNWIND batches, as Graph.write_batches does, and put on a queue of at most
+# queue_size batches that writer tasks take them from. When the writers fall behind the queue fills up and the
+# conversion waits, so memory stays bounded however fast the bundles are converted.
+#
+# All the nodes are written before any edge: the edges phase only starts once every node batch has been
+# written, so the MATCH on both ends of an edge always finds them. A failed write fails the phase: no more
+# bundles are converted and the batches still on the queue are not written.
+#
+# Usage, from a notebook (or with asyncio.run from a script):
+#   async with AsyncGraph(NEO4J_URI, USERNAME, PASSWORD) as async_graph:
+#       print(await load_bundles_async(async_graph, './working/bundles', writers=4))
+
+
+# Applies convert to each item in the executor and yields the results in item order, with at most max_pending
+# items converted ahead of the consumer. When the consumer stops early, the conversions not started yet are
+# cancelled.
+async def convert_bundles_async(convert, items, executor, max_pending):
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(loop.run_in_executor(executor, convert, *item))
+            if len(pending) >= max_pending:
+                yield await pending.popleft()
+        while len(pending) > 0:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def node_records_async(items, executor, max_pending, date_nodes=False, projection=None):
+    seen_dates = set()
+    async for records in convert_bundles_async(bundle_node_records, bundle_items(items, date_nodes, projection),
+                                               executor, max_pending):
+        yield list(unique_dates(records, seen_dates))
+
+
+async def edge_records_async(items, executor, max_pending, date_nodes=False):
+    async for records in convert_bundles_async(bundle_edge_records, bundle_items(items, date_nodes), executor,
+                                               max_pending):
+        yield records
+
+
+# Groups the records of each bundle by the statement they need and puts them on the queue in batches of
+# batch_size rows. If more than window records are pending, all the groups are put on the queue.
+# Stops converting the bundles as soon as a writer sets failed.
+async def queue_batches(records, record_batch, queue, batch_size, window, failed):
+    pending = {}
+    pending_count = 0
+    try:
+        async for bundle_records in records:
+            if failed.is_set():
+                return
+            for record in bundle_records:
+                cypher, row = record_batch(record)
+                rows = pending.setdefault(cypher, [])
+                rows.append(row)
+                pending_count += 1
+                if len(rows) >= batch_size:
+                    await queue.put((cypher, rows))
+                    pending_count -= len(rows)
+                    del pending[cypher]
+                elif window is not None and pending_count >= window:
+                    for cypher, rows in pending.items():
+                        await queue.put((cypher, rows))
+                    pending = {}
+                    pending_count = 0
+    finally:
+        await records.aclose()
+    for cypher, rows in pending.items():
+        await queue.put((cypher, rows))
+
+
+# Takes batches from the queue and writes them until it gets None. After a failed write failed is set, so the
+# producer stops, and the remaining batches are taken but not written, so the producer never waits on a full queue.
+# The error is raised by write_phase.
+async def write_queued_batches(graph, queue, totals, failed):
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            return
+        if len(totals['errors']) > 0:
+            continue
+        cypher, rows = batch
+        try:
+            result, runtime = await graph.write_transaction([(cypher, {'rows': rows})])
+            totals['count'] += len(rows)
+            totals['runtime'] += runtime
+        except Exception as e:
+            totals['errors'].append(e)
+            failed.set()
+
+
+# Writes the records with writers concurrent writer tasks, and returns once they are all written.
+# Returns the number of records written and the total runtime of the writes.
+async def write_phase(graph, records, record_batch, writers, queue_size, batch_size, window):
+    queue = asyncio.Queue(maxsize=queue_size)
+    totals = {'count': 0, 'runtime': 0, 'errors': []}
+    failed = asyncio.Event()
+    tasks = [asyncio.create_task(write_queued_batches(graph, queue, totals, failed)) for i in range(writers)]
+    try:
+        await queue_batches(records, record_batch, queue, batch_size, window, failed)
+    finally:
+        for task in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    if len(totals['errors']) > 0:
+        raise totals['errors'][0]
+    return totals['count'], totals['runtime']
+
+
+# Same as FHIR_pipeline.load_bundles (without incremental loading), on an AsyncGraph. As the writes overlap, the
+# runtime (the sum of the runtimes of the writes) can be more than the elapsed time.
+async def load_bundles_async(graph, bundle_dir, batch_size=1000, window=10000, processes=1, writers=4,
+                             queue_size=None, max_pending=None, date_nodes=False, neighbor_context=True,
+                             projection=None):
+    start = time.perf_counter()
+    file_names = bundle_file_names(bundle_dir)
+    if queue_size is None:
+        queue_size = writers * 2
+    if max_pending is None:
+        max_pending = max(processes, 1) * 2
+    if processes > 1:
+        executor = ProcessPoolExecutor(processes)
+    else:
+        executor = ThreadPoolExecutor(1)
+
+    with executor:
+        node_count, node_runtime = await write_phase(
+            graph, node_records_async(file_names, executor, max_pending, date_nodes, projection), node_record_batch,
+            writers, queue_size, batch_size, window)
+        edge_count, edge_runtime = await write_phase(
+            graph, edge_records_async(file_names, executor, max_pending, date_nodes), edge_record_batch,
+            writers, queue_size, batch_size, window)
+
+    context_count, context_runtime = 0, 0
+    if neighbor_context:
+        context_count, context_runtime = await graph.materialize_neighbor_context(batch_size=batch_size)
+    return {
+        'bundles': len(file_names),
+        'nodes': node_count,
+        'edges': edge_count,
+        'neighbor_contexts': context_count,
+        'runtime': node_runtime + edge_runtime + context_runtime,
+        'elapsed': time.perf_counter() - start
+    }
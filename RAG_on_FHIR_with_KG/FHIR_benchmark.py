@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from FHIR_async_pipeline import load_bundles_async
+from FHIR_flattener import flatten_fhir
+from FHIR_metrics import metrics
+from FHIR_pipeline import bundle_file_names, read_bundle, load_bundles, skipped_resource_types
+from FHIR_synthetic import SyntheticConfig, synthetic_bundles, write_synthetic_bundles
+from FHIR_to_graph import resource_to_node, resource_to_edges
+from FHIR_to_string import FHIR_to_string, FHIR_bundle_to_strings
+from NEO4J_Graph import Graph, AsyncGraph
+
+# Benchmarks for the conversion functions and for loading bundles, run over synthetic Synthea-shaped bundles.
+# Usage:
+#   python FHIR_benchmark.py --patients 20 --output bench.json
+#   python FHIR_benchmark.py --patients 20 --output bench_new.json --compare bench.json
+# Before timing anything the compiled conversion is checked against the generic one (see check_compiled_strings),
+# --check only runs that check, over the populations of several seeds.
+
+
+class FakeRecord:
+    def __init__(self, values):
+        self._values = values
+
+    def values(self):
+        return self._values
+
+
+# In-process stand-in for a neo4j driver, so Graph (and everything built on it) can be run without a database.
+# It accepts every statement, counts the statements and UNWIND rows it was sent, and returns no records.
+class FakeDriver:
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+
+    def session(self, **config):
+        return FakeSession(self)
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def run(self, cypher, parameters=None, **kwargs):
+        self._driver.statements += 1
+        if parameters is not None and 'rows' in parameters:
+            self._driver.rows += len(parameters['rows'])
+        return []
+
+    def execute_write(self, transaction_function, *args, **kwargs):
+        return transaction_function(self, *args, **kwargs)
+
+    def execute_read(self, transaction_function, *args, **kwargs):
+        return transaction_function(self, *args, **kwargs)
+
+
+# Same as FakeDriver, for AsyncGraph. Each transaction waits latency seconds, to stand in for the round trip to
+# the database that concurrent writers overlap.
+class FakeAsyncDriver:
+    def __init__(self, latency=0.0):
+        self.statements = 0
+        self.rows = 0
+        self.latency = latency
+
+    def session(self, **config):
+        return FakeAsyncSession(self)
+
+    async def close(self):
+        pass
+
+
+class FakeAsyncResult:
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+class FakeAsyncSession:
+    def __init__(self, driver):
+        self._driver = driver
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def run(self, cypher, parameters=None, **kwargs):
+        self._driver.statements += 1
+        if parameters is not None and 'rows' in parameters:
+            self._driver.rows += len(parameters['rows'])
+        return FakeAsyncResult()
+
+    async def execute_write(self, transaction_function, *args, **kwargs):
+        if self._driver.latency > 0:
+            await asyncio.sleep(self._driver.latency)
+        return await transaction_function(self, *args, **kwargs)
+
+
+# Runs function repeat times and returns the timings, items is how many things (resources, bundles) one run handles
+def benchmark(function, items, repeat):
+    runs = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    best = min(runs)
+    return {
+        'items': items,
+        'repeat': repeat,
+        'seconds_min': best,
+        'seconds_median': statistics.median(runs),
+        'items_per_second': items / best if best > 0 else None
+    }
+
+
+# Checks that FHIR_to_string(resource, compiled=True) returns exactly the sentences of FHIR_to_string(resource) for
+# every resource of the bundles. Returns the number of resources checked, raises an Exception on the first one that
+# differs.
+def check_compiled_strings(bundles):
+    count = 0
+    for bundle in bundles:
+        for entry in bundle['entry']:
+            resource = entry['resource']
+            expected = FHIR_to_string(resource)
+            compiled = FHIR_to_string(resource, compiled=True)
+            if compiled != expected:
+                raise Exception(f'Compiled conversion of {resource["resourceType"]} {resource["id"]} differs:\n'
+                                f'{expected}\n{compiled}')
+            count += 1
+    return count
+
+
+def run_microbenchmarks(file_names, repeat):
+    patient_bundles = [read_bundle(file_name) for file_name in file_names
+                       if not os.path.basename(file_name).startswith(('hospitalInformation', 'practitionerInformation'))]
+    resources = [entry['resource'] for bundle in patient_bundles for entry in bundle['entry']
+                 if entry['resource']['resourceType'] not in skipped_resource_types]
+
+    def each_resource(function):
+        return lambda: [function(resource) for resource in resources]
+
+    return {
+        'flatten_fhir': benchmark(each_resource(flatten_fhir), len(resources), repeat),
+        'FHIR_to_string': benchmark(each_resource(FHIR_to_string), len(resources), repeat),
+        'FHIR_to_string_compiled': benchmark(each_resource(lambda resource: FHIR_to_string(resource, compiled=True)),
+                                             len(resources), repeat),
+        'FHIR_bundle_to_strings': benchmark(lambda: [FHIR_bundle_to_strings(bundle) for bundle in patient_bundles],
+                                            len(patient_bundles), repeat),
+        'resource_to_node': benchmark(each_resource(resource_to_node), len(resources), repeat),
+        'resource_to_node_records': benchmark(each_resource(lambda resource: resource_to_node(resource, as_records=True)),
+                                              len(resources), repeat),
+        'resource_to_edges': benchmark(each_resource(resource_to_edges), len(resources), repeat),
+        'resource_to_edges_records': benchmark(each_resource(lambda resource: resource_to_edges(resource, as_records=True)),
+                                               len(resources), repeat),
+    }
+
+
+def run_load_benchmark(bundle_dir, repeat, batch_size, processes):
+    driver = FakeDriver()
+    graph = Graph(None, None, None, driver=driver)
+    file_names = bundle_file_names(bundle_dir)
+    result = benchmark(lambda: load_bundles(graph, bundle_dir, batch_size=batch_size, processes=processes),
+                       len(file_names), repeat)
+    result['statements'] = driver.statements // repeat
+    result['rows'] = driver.rows // repeat
+    return result
+
+
+def run_async_load_benchmark(bundle_dir, repeat, batch_size, processes, writers):
+    driver = FakeAsyncDriver()
+    graph = AsyncGraph(None, None, None, driver=driver)
+    file_names = bundle_file_names(bundle_dir)
+    load = lambda: asyncio.run(load_bundles_async(graph, bundle_dir, batch_size=batch_size, processes=processes,
+                                                  writers=writers))
+    result = benchmark(load, len(file_names), repeat)
+    result['statements'] = driver.statements // repeat
+    result['rows'] = driver.rows // repeat
+    return result
+
+
+def compare(previous, current):
+    lines = [f'{"benchmark":<32} {"previous":>12} {"current":>12} {"speedup":>8}']
+    for name, result in current['results'].items():
+        if name in previous['results']:
+            before = previous['results'][name]['seconds_min']
+            after = result['seconds_min']
+            lines.append(f'{name:<32} {before:>12.4f} {after:>12.4f} {before / after:>7.2f}x')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark FHIR conversion and graph loading on synthetic bundles.')
+    parser.add_argument('--patients', type=int, default=10)
+    parser.add_argument('--encounters', type=int, default=10, help='encounters per patient')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--writers', type=int, default=4, help='concurrent writers of the async load')
+    parser.add_argument('--bundle-dir', help='use (or create) the synthetic bundles in this directory')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='results file of a previous run to compare against')
+    parser.add_argument('--check', type=int, metavar='SEEDS',
+                        help='only check the compiled conversion, over the populations of this many seeds')
+    args = parser.parse_args(argv)
+
+    if args.check is not None:
+        for seed in range(args.seed, args.seed + args.check):
+            config = SyntheticConfig(patients=args.patients, encounters_per_patient=args.encounters, seed=seed)
+            count = check_compiled_strings(bundle for file_name, bundle in synthetic_bundles(config))
+            print(f'seed {seed}: {count} resources converted the same by the compiled conversion')
+        return
+
+    config = SyntheticConfig(patients=args.patients, encounters_per_patient=args.encounters, seed=args.seed)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bundle_dir = args.bundle_dir if args.bundle_dir is not None else temp_dir
+        if len(bundle_file_names(bundle_dir)) == 0:
+            write_synthetic_bundles(bundle_dir, config)
+        file_names = bundle_file_names(bundle_dir)
+        check_compiled_strings(read_bundle(file_name) for file_name in file_names)
+
+        results = run_microbenchmarks(file_names, args.repeat)
+        metrics.reset()
+        metrics.enable()
+        results['load_bundles'] = run_load_benchmark(bundle_dir, args.repeat, args.batch_size, args.processes)
+        results['load_bundles_async'] = run_async_load_benchmark(bundle_dir, args.repeat, args.batch_size,
+                                                                 args.processes, args.writers)
+        metrics.disable()
+
+    output = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'config': dict(config.to_dict(), repeat=args.repeat, batch_size=args.batch_size, processes=args.processes,
+                       writers=args.writers),
+        'results': results,
+        'load_metrics': metrics.to_dict()
+    }
+    with open(args.output, 'w') as out_file:
+        json.dump(output, out_file, indent=2)
+
+    for name, result in results.items():
+        print(f'{name:<32} {result["seconds_min"]:>10.4f}s  {result["items"]:>8} items')
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            print(compare(json.load(previous_file), output))
+
+
+if __name__ == '__main__':
+    main()
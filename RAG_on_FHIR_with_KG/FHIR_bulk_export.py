@@ -0,0 +1,199 @@
+import csv
+import datetime
+import os
+
+from FHIR_pipeline import bundle_file_names, bundle_resources, bundle_node_records, bundle_edge_records, \
+    convert_bundles, unique_dates
+from FHIR_to_graph import flatten_fhir, npi_to_key, practitioner_label, date_label
+
+# Export of bundles to the CSV files read by Neo4j's offline bulk importer (neo4j-admin database import full), for
+# the first load of a large population into an empty database. The nodes and relationships are the ones
+# load_bundles creates, from the same resource_to_node and resource_to_edges records.
+#
+# The bundles are read twice, one at a time:
+#   1. the property names of the resources of each type (each type gets its own node file, whose header needs them
+#      all), the ids of the resources and the id of each practitioner by NPI
+#   2. the rows of the node and relationship files
+# References are resolved in Python with what was found in the first pass: references to practitioners (by NPI)
+# are written as references to the id of the Practitioner resource, and references to resources that are not in
+# any bundle are counted as dangling and not written, so the importer never sees a relationship it can't resolve.
+#
+# Every file has a separate header file. Once exported, run the command returned in 'command' (the database must
+# be stopped and empty), then start it and run Graph.ensure_schema().
+
+# ID spaces of the import. Practitioners are resources, so they are in the resource ID space, under their id.
+resource_id_space = 'Resource'
+date_id_space = 'Date'
+
+array_delimiter = ';'
+
+# Node properties every resource can have, with their import type
+fixed_node_columns = [
+    (f'id:ID({resource_id_space})', 'id'),
+    (':LABEL', None),
+    ('name', 'name'),
+    ('text', 'text'),
+    ('content_hash', 'content_hash'),
+    ('dates:date[]', 'dates'),
+    ('date_min:date', 'date_min'),
+    ('date_max:date', 'date_max'),
+]
+
+relationship_header = [f':START_ID({resource_id_space})', f':END_ID({resource_id_space})', ':TYPE', 'date:date']
+date_relationship_header = [f':START_ID({resource_id_space})', f':END_ID({date_id_space})', ':TYPE', 'date:date']
+date_node_header = [f'id:ID({date_id_space})', ':LABEL', 'name']
+
+
+# First pass over one bundle: {resource type: [property names]}, the ids of the resources and {npi: id} of the
+# practitioners. The projection doesn't write to its blob store here, the second pass does.
+def bundle_export_keys(bundle_file_name, projection=None):
+    if projection is not None:
+        projection = projection.without_blob_store()
+    keys = {}
+    ids = []
+    npis = {}
+    npi_key = npi_to_key('')
+    for resource in bundle_resources([bundle_file_name]):
+        flat_resource = flatten_fhir(projection.project(resource) if projection is not None else resource)
+        type_keys = keys.setdefault(resource['resourceType'], {})
+        for attrib in flat_resource:
+            type_keys[attrib] = None
+        ids.append(resource['id'])
+        if resource['resourceType'] == practitioner_label and \
+                flat_resource.get('identifier_0_system') == npi_key['identifier_0_system']:
+            npis[str(flat_resource['identifier_0_value'])] = resource['id']
+    return {resource_type: list(type_keys) for resource_type, type_keys in keys.items()}, ids, npis
+
+
+# Second pass over one bundle: its node records and edge records
+def bundle_export_records(bundle_file_name, date_nodes=False, projection=None):
+    return (bundle_node_records(bundle_file_name, None, date_nodes, projection),
+            bundle_edge_records(bundle_file_name, None, date_nodes))
+
+
+def value_to_csv(value):
+    if value is None:
+        return ''
+    elif type(value) is list:
+        return array_delimiter.join(value_to_csv(item) for item in value)
+    elif isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+# Files of one kind of node or relationship: the header file, written once, and the data file rows are added to
+class ImportFile:
+    def __init__(self, directory, name, header):
+        self.header_file_name = os.path.join(directory, f'{name}.header.csv')
+        self.file_name = os.path.join(directory, f'{name}.csv')
+        with open(self.header_file_name, 'w', newline='', encoding='utf-8') as header_file:
+            csv.writer(header_file).writerow(header)
+        self._file = open(self.file_name, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self.count = 0
+
+    def write(self, row):
+        self._writer.writerow(row)
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def import_arg(self):
+        return f'{self.header_file_name},{self.file_name}'
+
+
+# The node file of one resource type, with a column for every property its resources have
+class ResourceNodeFile(ImportFile):
+    def __init__(self, directory, resource_type, keys):
+        fixed_properties = set(name for column, name in fixed_node_columns)
+        self.columns = fixed_node_columns + [(key, key) for key in keys if key not in fixed_properties]
+        self._properties = set(name for column, name in self.columns if name is not None)
+        super().__init__(directory, f'nodes_{resource_type}', [column for column, name in self.columns])
+
+    def write_record(self, record):
+        properties = record['properties']
+        for name in properties:
+            if name not in self._properties:
+                raise Exception(f'Property {name} of {properties["id"]} was not found in the first pass')
+        self.write([array_delimiter.join(record['labels']) if name is None else value_to_csv(properties.get(name))
+                    for column, name in self.columns])
+
+
+# Writes the CSV files for all the bundles in bundle_dir to output_dir, and returns counts and the import command.
+# With date_nodes=True the Date nodes and the edges to them are exported too, as load_bundles does, and with a
+# projection the nodes are projected as load_bundles does it.
+def export_bundles(bundle_dir, output_dir, processes=1, date_nodes=False, database='neo4j', projection=None):
+    file_names = bundle_file_names(bundle_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    keys = {}
+    ids = set()
+    npis = {}
+    items = [(file_name, projection) for file_name in file_names]
+    for bundle_keys, bundle_ids, bundle_npis in convert_bundles(bundle_export_keys, items, processes):
+        for resource_type, type_keys in bundle_keys.items():
+            all_type_keys = keys.setdefault(resource_type, {})
+            for key in type_keys:
+                all_type_keys[key] = None
+        ids.update(bundle_ids)
+        npis.update(bundle_npis)
+
+    node_files = {resource_type: ResourceNodeFile(output_dir, resource_type, list(type_keys))
+                  for resource_type, type_keys in keys.items()}
+    relationship_file = ImportFile(output_dir, 'relationships', relationship_header)
+    date_files = None
+    if date_nodes:
+        date_files = (ImportFile(output_dir, 'nodes_Date', date_node_header),
+                      ImportFile(output_dir, 'relationships_Date', date_relationship_header))
+
+    dangling = 0
+    seen_dates = set()
+    try:
+        items = [(file_name, date_nodes, projection) for file_name in file_names]
+        for node_records, edge_records in convert_bundles(bundle_export_records, items, processes):
+            for record in unique_dates(node_records, seen_dates):
+                if record['labels'] == [date_label]:
+                    properties = record['properties']
+                    date_files[0].write([properties['id'], date_label, properties['name']])
+                else:
+                    node_files[record['labels'][0]].write_record(record)
+
+            for record in edge_records:
+                start = record['start']['id']
+                date = value_to_csv(record.get('properties', {}).get('date'))
+                if record['end_label'] == date_label:
+                    date_files[1].write([start, record['end']['id'], record['type'], date])
+                    continue
+                if record['end_label'] == practitioner_label:
+                    end = npis.get(str(record['end']['identifier_0_value']))
+                else:
+                    end = record['end']['id'] if record['end']['id'] in ids else None
+                if end is None:
+                    dangling += 1
+                else:
+                    relationship_file.write([start, end, record['type'], date])
+    finally:
+        for import_file in list(node_files.values()) + [relationship_file] + list(date_files or []):
+            import_file.close()
+
+    node_args = [node_file.import_arg() for node_file in node_files.values()]
+    relationship_args = [relationship_file.import_arg()]
+    if date_nodes:
+        node_args.append(date_files[0].import_arg())
+        relationship_args.append(date_files[1].import_arg())
+    command = ' '.join(
+        ['neo4j-admin database import full', f'--array-delimiter="{array_delimiter}"', '--multiline-fields=true'] +
+        [f'--nodes={arg}' for arg in node_args] +
+        [f'--relationships={arg}' for arg in relationship_args] +
+        [database]
+    )
+
+    return {
+        'bundles': len(file_names),
+        'nodes': {resource_type: node_file.count for resource_type, node_file in node_files.items()},
+        'dates': date_files[0].count if date_nodes else 0,
+        'relationships': relationship_file.count + (date_files[1].count if date_nodes else 0),
+        'dangling_references': dangling,
+        'command': command
+    }
@@ -0,0 +1,223 @@
+import pickle
+import re
+
+from FHIR_corpus import is_patient_bundle
+from FHIR_flattener import find_patient, resource_metadata
+from FHIR_pipeline import bundle_file_names, read_bundle, convert_bundles, skipped_resource_types
+from FHIR_to_graph import resource_label
+from FHIR_to_string import FHIR_to_string, patient_to_str
+
+# Chunking of the texts of the resources for embedding. bge-small (and most sentence embedders) only reads the
+# first 512 tokens of a text and silently drops the rest, which loses most of a Claim or an ExplanationOfBenefit
+# with many items. FHIR_to_string returns a list of sentences, so rather than joining them into one text they are
+# packed into chunks that fit the token budget, each with the patient header in front.
+#
+# Each chunk knows the resource it comes from (resource_id in its metadata), so a hit on a chunk maps back to the
+# resource. In the graph a chunk is a Chunk node with the text and embedding of the chunk, linked to its resource
+# by a chunk_of relationship (see load_chunks and FHIR_retrieval.search_chunks).
+
+chunk_label = 'Chunk'
+chunk_relation = 'chunk_of'
+
+# Cypher that creates a batch of Chunk nodes and links each one to its resource, matched on id, so the chunks and
+# their edges are written from a single pass over the bundles. No chunk is created for a resource that isn't in the
+# graph.
+chunk_batch_cypher = f'''
+        UNWIND $rows AS row
+        MATCH (r:`{resource_label}` {{id: row.resource_id}})
+        CREATE (c:`{chunk_label}`)
+        SET c = row
+        CREATE (c)-[:`{chunk_relation}`]->(r)
+    '''
+
+# Tokens the model adds to every text ([CLS] and [SEP])
+special_tokens = 2
+
+token_pattern = re.compile(r'[^\W\d_]+|\d+|[^\w\s]|_')
+
+
+# A fast, conservative estimate of the number of WordPiece tokens of a text: every punctuation mark is one token,
+# and every word or number one token per 3 characters (started). WordPiece splits clinical terms and codes into
+# pieces of 2 to 4 characters (e.g. Hypertriglyceridemia into about 6, estimated at 7), so the estimate is above the
+# real count and chunks stay under the budget, at the cost of chunks shorter than they could be.
+# A real tokenizer can be used instead. With processes > 1 count_tokens is sent to the worker processes, so it must
+# be a module-level function (not a lambda or a nested function), e.g.
+#   tokenizer = AutoTokenizer.from_pretrained('BAAI/bge-small-en-v1.5')
+#   def count_tokens(text):
+#       return len(tokenizer.tokenize(text))
+def estimate_tokens(text):
+    count = 0
+    for token in token_pattern.findall(text):
+        count += 1 + (len(token) - 1) // 3
+    return count
+
+
+# Fails before any bundle is read when count_tokens can't be sent to the worker processes
+def check_count_tokens(count_tokens, processes):
+    if processes <= 1:
+        return
+    try:
+        pickle.dumps(count_tokens)
+    except Exception as e:
+        raise Exception(f'With processes > 1, count_tokens must be a module-level function: {e}')
+
+
+def chunk_text(header, sentences):
+    text = ' '.join(sentences)
+    if header is None:
+        return text
+    return f'{header}\n{text}'
+
+
+# Splits a sentence that doesn't fit the budget on its own into pieces that do, on whitespace
+def split_sentence(sentence, budget, count_tokens):
+    pieces = []
+    words = []
+    tokens = 0
+    for word in sentence.split():
+        word_tokens = count_tokens(word)
+        if len(words) > 0 and tokens + word_tokens > budget:
+            pieces.append(' '.join(words))
+            words = []
+            tokens = 0
+        words.append(word)
+        tokens += word_tokens
+    if len(words) > 0:
+        pieces.append(' '.join(words))
+    return pieces
+
+
+# Packs the sentences, in order, into as few texts as fit in max_tokens with the header (if any) in front of each.
+# Returns the texts of the chunks.
+def chunk_sentences(sentences, header=None, max_tokens=512, count_tokens=estimate_tokens):
+    budget = max_tokens - special_tokens
+    if header is not None:
+        budget -= count_tokens(header)
+    if budget <= 0:
+        raise Exception(f'The header alone is more than {max_tokens} tokens')
+
+    chunks = []
+    chunk = []
+    tokens = 0
+    for sentence in sentences:
+        sentence_tokens = count_tokens(sentence)
+        pieces = [sentence] if sentence_tokens <= budget else split_sentence(sentence, budget, count_tokens)
+        for piece in pieces:
+            piece_tokens = sentence_tokens if len(pieces) == 1 else count_tokens(piece)
+            if len(chunk) > 0 and tokens + piece_tokens > budget:
+                chunks.append(chunk_text(header, chunk))
+                chunk = []
+                tokens = 0
+            chunk.append(piece)
+            tokens += piece_tokens
+    if len(chunk) > 0:
+        chunks.append(chunk_text(header, chunk))
+    return chunks
+
+
+def chunk_id(resource_id, index):
+    return f'{resource_id}#{index}'
+
+
+# Returns the texts of the chunks of a resource, [] for the resources that have no text
+def resource_chunks(resource, header=None, max_tokens=512, count_tokens=estimate_tokens):
+    sentences = FHIR_to_string(resource)
+    if sentences is None:
+        return []
+    return chunk_sentences(sentences, header, max_tokens, count_tokens)
+
+
+# The patient header of the bundle, None for the bundles without a Patient
+def bundle_chunk_header(bundle):
+    if not is_patient_bundle(bundle):
+        return None
+    patient, patient_name = find_patient(bundle)
+    return patient_to_str(patient)
+
+
+# Yields (text, metadata) for each chunk of each resource of the patient bundles, e.g. for a CorpusWriter or
+# FHIR_vector_store.build_vector_store. The metadata is the one of the resource (see resource_metadata) with the
+# id and the index of the chunk.
+def bundle_chunk_documents(bundles, max_tokens=512, count_tokens=estimate_tokens):
+    for bundle in bundles:
+        if not is_patient_bundle(bundle):
+            continue
+        patient, patient_name = find_patient(bundle)
+        header = patient_to_str(patient)
+        for entry in bundle['entry']:
+            resource = entry['resource']
+            if resource['resourceType'] in skipped_resource_types:
+                continue
+            metadata = resource_metadata(resource, patient)
+            for index, text in enumerate(resource_chunks(resource, header, max_tokens, count_tokens)):
+                yield text, dict(metadata, chunk_id=chunk_id(resource['id'], index), chunk=index)
+
+
+# The node records of the chunks of every resource in the bundle (or only the ones in resource_ids), in the form of
+# the records of FHIR_to_graph, to be written with chunk_record_batch
+def bundle_chunk_records(bundle_file_name, max_tokens=512, count_tokens=estimate_tokens, resource_ids=None):
+    bundle = read_bundle(bundle_file_name)
+    header = bundle_chunk_header(bundle)
+    node_records = []
+    for entry in bundle['entry']:
+        resource = entry['resource']
+        if resource['resourceType'] in skipped_resource_types:
+            continue
+        if resource_ids is not None and resource['id'] not in resource_ids:
+            continue
+        for index, text in enumerate(resource_chunks(resource, header, max_tokens, count_tokens)):
+            id = chunk_id(resource['id'], index)
+            node_records.append({'labels': [chunk_label], 'properties': {
+                'id': id, 'resource_id': resource['id'], 'chunk': index, 'text': text
+            }})
+    return node_records
+
+
+def chunk_record_batch(record):
+    return chunk_batch_cypher, record['properties']
+
+
+# Creates the Chunk nodes of every resource of the bundles in bundle_dir and links them to their resources, which
+# must already be loaded (see FHIR_pipeline.load_bundles). To rebuild the chunks, e.g. with another max_tokens,
+# delete the old ones first with Graph.delete_chunks. Then embed them with
+#   embed_graph(graph, embedder, cache, model_name, label=chunk_label)
+# and index them with graph.ensure_vector_index(dimensions, index_name='fhir_chunks', label=chunk_label).
+def load_chunks(graph, bundle_dir, max_tokens=512, count_tokens=estimate_tokens, batch_size=1000, window=10000,
+                processes=1):
+    check_count_tokens(count_tokens, processes)
+    file_names = bundle_file_names(bundle_dir)
+    items = [(file_name, max_tokens, count_tokens) for file_name in file_names]
+    chunk_count, runtime = graph.write_batches(
+        (record for records in convert_bundles(bundle_chunk_records, items, processes) for record in records),
+        chunk_record_batch, batch_size, window)
+    return {
+        'bundles': len(file_names),
+        'chunks': chunk_count,
+        'runtime': runtime
+    }
+
+
+# The chunking of a load: FHIR_pipeline.load_bundles(..., chunker=Chunker()) creates the chunks of every resource
+# once the nodes are loaded, as load_chunks does. With incremental=True it deletes the chunks of the resources that
+# changed and creates them again with the same max_tokens and count_tokens. The new chunks have no embedding yet,
+# embed_graph(..., label=chunk_label) only embeds those.
+class Chunker:
+    def __init__(self, max_tokens=512, count_tokens=estimate_tokens):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+
+    # Creates the chunks of every resource of the bundles. Returns the number of chunks created and the runtime.
+    def load_chunks(self, graph, file_names, batch_size=1000, window=10000, processes=1):
+        return self.load_changed_chunks(graph, [(file_name, None) for file_name in file_names], batch_size, window,
+                                        processes)
+
+    # Creates the chunks of the resources in changed, [(bundle file name, resource ids)] as collected by
+    # FHIR_pipeline.changed_bundles. Their old chunks must have been deleted. Returns the number of chunks created
+    # and the runtime.
+    def load_changed_chunks(self, graph, changed, batch_size=1000, window=10000, processes=1):
+        check_count_tokens(self.count_tokens, processes)
+        items = [(bundle_file_name, self.max_tokens, self.count_tokens, resource_ids)
+                 for bundle_file_name, resource_ids in changed]
+        return graph.write_batches(
+            (record for records in convert_bundles(bundle_chunk_records, items, processes) for record in records),
+            chunk_record_batch, batch_size, window)
@@ -0,0 +1,209 @@
+import json
+import os
+from array import array
+
+from FHIR_flattener import FHIR_flatten_bundle, FHIR_flatten_bundle_header, filter_for_patient, find_patient
+from FHIR_pipeline import read_bundle, convert_bundles
+from FHIR_to_string import FHIR_bundle_to_strings, FHIR_bundle_header
+
+# A packed corpus of the texts of the resources: one data file with all the texts, and an index with one JSON
+# line per text, instead of one small file per resource.
+#   <path>.data          the texts, utf-8, one after the other
+#   <path>.index.jsonl   for each text its offset and length (in bytes) in the data file, and its metadata
+#                        (resource_id, patient_id and resource_type, plus anything else it was added with)
+#   <path>.headers.jsonl the patient headers of a corpus written with shared_header=True, one JSON line per patient
+#
+# By default each text starts with the header of its patient, as FHIR_bundle_to_strings and FHIR_flatten_bundle
+# return them. With shared_header=True the header is stored once per patient instead of once per resource, the
+# texts have shared_header set in their metadata, and CorpusReader puts the header back in front of them when they
+# are read (or leaves them without it with attach_headers=False, e.g. to embed the texts without the header).
+
+
+def is_patient_bundle(bundle):
+    return any(filter_for_patient(entry) for entry in bundle['entry'])
+
+
+# Yields (text, metadata) for each resource of the patient bundles. Bundles without a Patient (the hospital and
+# practitioner bundles) are skipped. With flattened=True the texts come from FHIR_flatten_bundle instead of
+# FHIR_bundle_to_strings. With shared_header=True the texts are without the patient header (see bundle_header).
+def bundle_documents(bundles, flattened=False, shared_header=False):
+    for bundle in bundles:
+        if not is_patient_bundle(bundle):
+            continue
+        if flattened:
+            texts, patient_name, metadata = FHIR_flatten_bundle(bundle, with_metadata=True,
+                                                                include_header=not shared_header)
+        else:
+            texts, patient_name, metadata = FHIR_bundle_to_strings(bundle, with_metadata=True,
+                                                                   include_header=not shared_header)
+        if shared_header:
+            metadata = [dict(item, shared_header=True) for item in metadata]
+        yield from zip(texts, metadata)
+
+
+# (patient id, header) of a patient bundle, None for the other bundles
+def bundle_header(bundle, flattened=False):
+    if not is_patient_bundle(bundle):
+        return None
+    patient, patient_name = find_patient(bundle)
+    if flattened:
+        return patient['PatientID'], FHIR_flatten_bundle_header(bundle)
+    return patient['PatientID'], FHIR_bundle_header(bundle)
+
+
+# The text of a document stored without its header, as it would be with the header. The text is returned as is
+# when there is no header (e.g. the headers file of the corpus is missing).
+def with_header(header, text):
+    if header is None:
+        return text
+    return f'{header}\n{text}'
+
+
+# Returns (header, documents), where header is None unless shared_header=True
+def bundle_file_documents(bundle_file_name, flattened=False, shared_header=False):
+    bundle = read_bundle(bundle_file_name)
+    header = bundle_header(bundle, flattened) if shared_header else None
+    return header, list(bundle_documents([bundle], flattened, shared_header))
+
+
+def corpus_file_names(path):
+    return f'{path}.data', f'{path}.index.jsonl'
+
+
+def corpus_headers_file_name(path):
+    return f'{path}.headers.jsonl'
+
+
+class CorpusWriter:
+    def __init__(self, path):
+        data_file_name, index_file_name = corpus_file_names(path)
+        directory = os.path.dirname(data_file_name)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        self._data = open(data_file_name, 'wb')
+        self._index = open(index_file_name, 'w', encoding='utf-8')
+        self._headers = open(corpus_headers_file_name(path), 'w', encoding='utf-8')
+        self._offset = 0
+        self.count = 0
+
+    def add(self, text, metadata):
+        data = text.encode('utf-8')
+        self._data.write(data)
+        self._index.write(json.dumps(dict(metadata, offset=self._offset, length=len(data))) + '\n')
+        self._offset += len(data)
+        self.count += 1
+
+    def add_header(self, patient_id, header):
+        self._headers.write(json.dumps({'patient_id': patient_id, 'header': header}) + '\n')
+
+    # Adds the texts of a bundle (see bundle_documents), and with shared_header=True the header of its patient
+    def add_bundle(self, bundle, flattened=False, shared_header=False):
+        if shared_header:
+            header = bundle_header(bundle, flattened)
+            if header is not None:
+                self.add_header(*header)
+        for text, metadata in bundle_documents([bundle], flattened, shared_header):
+            self.add(text, metadata)
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+        self._headers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Writes the texts of the bundles to a corpus at path, converting them in processes worker processes.
+# Returns the number of texts.
+def write_corpus(file_names, path, flattened=False, processes=1, shared_header=False):
+    with CorpusWriter(path) as corpus:
+        items = [(file_name, flattened, shared_header) for file_name in file_names]
+        for header, documents in convert_bundles(bundle_file_documents, items, processes):
+            if header is not None:
+                corpus.add_header(*header)
+            for text, metadata in documents:
+                corpus.add(text, metadata)
+        return corpus.count
+
+
+# Reads a corpus without loading it: only the position of each line of the index is kept in memory.
+# corpus[i] reads the (text, metadata) of the i-th text, and iterating reads them all in order.
+# The patient headers, if any, are loaded on first use.
+class CorpusReader:
+    def __init__(self, path, attach_headers=True):
+        data_file_name, index_file_name = corpus_file_names(path)
+        self._headers_file_name = corpus_headers_file_name(path)
+        self._headers = None
+        self.attach_headers = attach_headers
+        self._data = open(data_file_name, 'rb')
+        self._index = open(index_file_name, 'rb')
+        self._index_offsets = array('q')
+        offset = 0
+        for line in self._index:
+            self._index_offsets.append(offset)
+            offset += len(line)
+        self._positions = None
+
+    def __len__(self):
+        return len(self._index_offsets)
+
+    def read(self, index_line):
+        metadata = json.loads(index_line)
+        self._data.seek(metadata.pop('offset'))
+        text = self._data.read(metadata.pop('length')).decode('utf-8')
+        if self.attach_headers and metadata.get('shared_header'):
+            text = with_header(self.header(metadata['patient_id']), text)
+        return text, metadata
+
+    # {patient id: shared header}
+    def headers(self):
+        if self._headers is None:
+            self._headers = {}
+            if os.path.exists(self._headers_file_name):
+                with open(self._headers_file_name, encoding='utf-8') as headers_file:
+                    for line in headers_file:
+                        item = json.loads(line)
+                        self._headers[item['patient_id']] = item['header']
+        return self._headers
+
+    # The shared header of a patient, None if there is none
+    def header(self, patient_id):
+        return self.headers().get(patient_id)
+
+    def __getitem__(self, i):
+        self._index.seek(self._index_offsets[i])
+        return self.read(self._index.readline())
+
+    def __iter__(self):
+        with open(self._index.name, 'rb') as index_file:
+            for line in index_file:
+                yield self.read(line)
+
+    # Position of the text of a resource, the map from resource id to position is built on first use
+    def position(self, resource_id):
+        if self._positions is None:
+            self._positions = {}
+            with open(self._index.name, 'rb') as index_file:
+                for i, line in enumerate(index_file):
+                    self._positions[json.loads(line).get('resource_id')] = i
+        return self._positions.get(resource_id)
+
+    def get(self, resource_id):
+        position = self.position(resource_id)
+        if position is None:
+            return None
+        return self[position]
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,139 @@
+import hashlib
+import os
+from array import array
+
+from FHIR_metrics import metrics, embedding_stage
+
+# Embedding of the text of the resource nodes, with an on-disk cache keyed by the hash of the text and the name of
+# the model. Re-embedding a corpus only pays for the texts that are not in the cache.
+#
+# The embedder can be anything with an embed_documents(texts) method that returns one vector per text,
+# e.g. langchain's HuggingFaceBgeEmbeddings(model_name="BAAI/bge-small-en-v1.5").
+
+
+def text_hash(text, model_name):
+    return hashlib.sha256(f'{model_name}\n{text}'.encode('utf-8')).hexdigest()
+
+
+# Truncates a text file after its last newline, dropping a line that was only partly written
+def truncate_to_last_line(file_name):
+    with open(file_name, 'rb+') as text_file:
+        text = text_file.read()
+        if len(text) > 0 and not text.endswith(b'\n'):
+            text_file.truncate(text.rfind(b'\n') + 1)
+
+
+# Append-only cache of vectors. The vectors are stored as float32 in embeddings.f32, and embeddings.idx has one
+# line per vector with its hash, offset (in floats) and dimensions. Vectors are only added to the index once their
+# data has been written, so an interrupted write is never read back. On open, what an interrupted write left after
+# the last indexed vector (or after the last whole line of the index) is truncated, so new vectors are appended
+# where the index expects them.
+class EmbeddingCache:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self._data_file_name = os.path.join(directory, 'embeddings.f32')
+        self._index_file_name = os.path.join(directory, 'embeddings.idx')
+        self._index = {}
+        self._size = 0
+        if os.path.exists(self._index_file_name):
+            truncate_to_last_line(self._index_file_name)
+            with open(self._index_file_name) as index_file:
+                for line in index_file:
+                    parts = line.split()
+                    if len(parts) == 3:
+                        offset, dimensions = int(parts[1]), int(parts[2])
+                        self._index[parts[0]] = (offset, dimensions)
+                        self._size = max(self._size, offset + dimensions)
+        if os.path.exists(self._data_file_name) and os.path.getsize(self._data_file_name) > self._size * 4:
+            os.truncate(self._data_file_name, self._size * 4)
+        self._data = open(self._data_file_name, 'ab+')
+        self._index_file = open(self._index_file_name, 'a')
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        location = self._index.get(key)
+        if location is None:
+            return None
+        offset, dimensions = location
+        vector = array('f')
+        self._data.seek(offset * 4)
+        vector.fromfile(self._data, dimensions)
+        return vector.tolist()
+
+    def put_many(self, keys_and_vectors):
+        index_lines = []
+        self._data.seek(0, os.SEEK_END)
+        for key, vector in keys_and_vectors:
+            if key in self._index:
+                continue
+            data = array('f', vector)
+            data.tofile(self._data)
+            self._index[key] = (self._size, len(data))
+            index_lines.append(f'{key} {self._size} {len(data)}\n')
+            self._size += len(data)
+        self._data.flush()
+        self._index_file.write(''.join(index_lines))
+        self._index_file.flush()
+
+    def close(self):
+        self._data.close()
+        self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Returns one vector per text. Texts found in the cache are not embedded again, the others are de-duplicated and
+# embedded batch_size at a time, and added to the cache.
+def embed_texts(texts, embedder, cache, model_name, batch_size=64):
+    keys = [text_hash(text, model_name) for text in texts]
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cache and key not in missing:
+            missing[key] = text
+
+    missing_keys = list(missing)
+    for start in range(0, len(missing_keys), batch_size):
+        batch_keys = missing_keys[start:start + batch_size]
+        with metrics.stage(embedding_stage, len(batch_keys)):
+            vectors = embedder.embed_documents([missing[key] for key in batch_keys])
+        cache.put_many(zip(batch_keys, vectors))
+
+    return [cache.get(key) for key in keys]
+
+
+# Embeds the text of every resource node (or every node with the given label, e.g. Chunk) in the graph and writes
+# the vectors to its embedding property, page_size nodes at a time. Nodes whose embedding was already made from the
+# same text and model are skipped, so a rebuild only embeds (and writes) what changed. Returns the number of nodes
+# that were updated.
+def embed_graph(graph, embedder, cache, model_name, batch_size=64, page_size=1000, write_batch_size=500,
+                label='resource'):
+    updated = 0
+    after = ''
+    while True:
+        page = graph.resource_texts(after, page_size, label)
+        if len(page) == 0:
+            return updated
+        after = page[-1][0]
+
+        changed = []
+        for id, text, embedding_hash in page:
+            key = text_hash(text, model_name)
+            if key != embedding_hash:
+                changed.append((id, text, key))
+        if len(changed) == 0:
+            continue
+
+        vectors = embed_texts([text for id, text, key in changed], embedder, cache, model_name, batch_size)
+        rows = [{'id': id, 'embedding': vector, 'embedding_hash': key}
+                for (id, text, key), vector in zip(changed, vectors)]
+        count, runtime = graph.set_embeddings(rows, write_batch_size, label)
+        updated += count
@@ -1,4 +1,7 @@
 import re
+import sys
+from functools import lru_cache
+from FHIR_metrics import metrics, flatten_stage
 
 camel_pattern1 = re.compile(r'(.)([A-Z][a-z]+)')
 camel_pattern2 = re.compile(r'([a-z0-9])([A-Z])')
@@ -15,24 +18,77 @@ def handle_special_attributes(attrib_name, value):
     return value
 
 
-def flatten_fhir(nested_json):
+# How flatten builds the keys of a flattened resource: the separator between the parts of the path, the
+# function that normalizes attribute names (memoized), the paths to skip (e.g. 'text_' skips the top level
+# text of a resource) and an optional function applied to the value of every leaf.
+class KeyStyle:
+    def __init__(self, separator, normalize, skip=(), leaf_value=None, max_prefixes=65536):
+        self.separator = separator
+        self.normalize = lru_cache(maxsize=8192)(normalize)
+        self.skip = frozenset(skip)
+        self.leaf_value = leaf_value
+        self.max_prefixes = max_prefixes
+        # {prefix: {attribute or index: child prefix}}, so the same path strings are built once and shared
+        self._prefixes = {}
+
+    def children(self, prefix):
+        children = self._prefixes.get(prefix)
+        if children is None:
+            if len(self._prefixes) >= self.max_prefixes:
+                self._prefixes.clear()
+            children = self._prefixes[prefix] = {}
+        return children
+
+    def child_prefix(self, children, prefix, attribute):
+        child = children.get(attribute)
+        if child is None:
+            if type(attribute) is int:
+                child = sys.intern(prefix + str(attribute) + self.separator)
+            else:
+                child = sys.intern(prefix + self.normalize(attribute) + self.separator)
+            children[attribute] = child
+        return child
+
+
+# Flattens nested FHIR into a dict of path to value, walking the resource with an explicit stack
+# instead of recursion
+def flatten(nested_json, style):
     out = {}
-
-    def flatten(json_to_flatten, name=''):
+    skip = style.skip
+    leaf_value = style.leaf_value
+    separator_length = len(style.separator)
+    stack = [(nested_json, '')]
+    while stack:
+        json_to_flatten, name = stack.pop()
+        if name in skip:
+            continue
         if type(json_to_flatten) is dict:
-            for sub_attribute in json_to_flatten:
-                flatten(json_to_flatten[sub_attribute], name + split_camel(sub_attribute) + ' ')
+            children = style.children(name)
+            for sub_attribute in reversed(json_to_flatten):
+                stack.append((json_to_flatten[sub_attribute], style.child_prefix(children, name, sub_attribute)))
         elif type(json_to_flatten) is list:
-            for i, sub_json in enumerate(json_to_flatten):
-                flatten(sub_json, name + str(i) + ' ')
+            children = style.children(name)
+            for i in range(len(json_to_flatten) - 1, -1, -1):
+                stack.append((json_to_flatten[i], style.child_prefix(children, name, i)))
         else:
-            attrib_name = name[:-1]
-            out[attrib_name] = handle_special_attributes(attrib_name, json_to_flatten)
-
-    flatten(nested_json)
+            attrib_name = name[:-separator_length]
+            if leaf_value is None:
+                out[attrib_name] = json_to_flatten
+            else:
+                out[attrib_name] = leaf_value(attrib_name, json_to_flatten)
     return out
 
 
+text_key_style = KeyStyle(' ', split_camel, leaf_value=handle_special_attributes)
+
+
+def flatten_fhir(nested_json):
+    if metrics.enabled:
+        with metrics.stage(flatten_stage):
+            return flatten(nested_json, text_key_style)
+    return flatten(nested_json, text_key_style)
+
+
 def filter_for_patient(entry):
     return entry['resource']['resourceType'] == "Patient"
 
@@ -68,11 +124,33 @@ def flat_to_string(flat_entry):
     return output
 
 
-def FHIR_flatten_bundle(bundle):
+def resource_metadata(resource, patient):
+    return {
+        'resource_id': resource['id'],
+        'patient_id': patient['PatientID'],
+        'resource_type': resource['resourceType']
+    }
+
+
+# The patient header that FHIR_flatten_bundle puts before the string of each resource
+def FHIR_flatten_bundle_header(bundle):
+    patient, patient_name = find_patient(bundle)
+    return flat_to_string(flatten_fhir(patient))
+
+
+# With with_metadata=True, also returns the resource id, patient id and resource type of each string.
+# With include_header=False the patient header is left out of the strings, so it can be stored once per patient
+# (see FHIR_flatten_bundle_header) instead of in every string.
+def FHIR_flatten_bundle(bundle, with_metadata=False, include_header=True):
     patient, patient_name = find_patient(bundle)
-    flat_patient = flatten_fhir(patient)
+    patient_str = flat_to_string(flatten_fhir(patient))
     output = []
+    metadata = []
     for entry in bundle['entry']:
-        flat_entry = flatten_fhir(entry['resource'])
-        output.append(f'{flat_to_string(flat_patient)}\n{flat_to_string(flat_entry)}')
+        entry_str = flat_to_string(flatten_fhir(entry['resource']))
+        output.append(f'{patient_str}\n{entry_str}' if include_header else entry_str)
+        if with_metadata:
+            metadata.append(resource_metadata(entry['resource'], patient))
+    if with_metadata:
+        return output, patient_name, metadata
     return output, patient_name
@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from FHIR_pipeline import bundle_file_names, bundle_node_records, bundle_edge_records, convert_bundles
+from FHIR_projection import Projection, BlobStore
+from FHIR_references import ReferenceResolver
+from FHIR_to_graph import date_label
+from NEO4J_Graph import Graph, node_record_merge_batch, edge_record_merge_batch
+
+# Resumable load of a directory of bundles into the graph, from the command line:
+#   python FHIR_ingest.py ./working/bundles --checkpoint ./working/ingest_checkpoint.json
+#
+# The load goes through the phases nodes, edges and context (see Graph.materialize_neighbor_context) and ends in
+# done. After each batch is committed, the checkpoint file records the phase and how far it got: the bundle file
+# (its base name) and the number of its records written (offset) for nodes and edges, the last resource id for context. Run again
+# after a crash, it resumes from there. The nodes and edges are written with MERGE, so the batch that was committed
+# but not yet recorded when the load stopped is written again without duplicating anything. Delete the checkpoint
+# (or pass --restart) to load from the start again.
+#
+# A batch is the next batch_size records in bundle order, across bundles, written in a single transaction.
+
+phases = ['nodes', 'edges', 'context', 'done']
+
+
+def new_checkpoint(bundle_dir, date_nodes):
+    return {
+        'bundle_dir': os.path.abspath(bundle_dir),
+        'date_nodes': date_nodes,
+        'phase': phases[0],
+        'bundle': None,
+        'offset': 0,
+        'after': '',
+        'counts': {phase: 0 for phase in phases[:-1]},
+        'runtime': {phase: 0 for phase in phases[:-1]},
+    }
+
+
+def load_checkpoint(checkpoint_file_name):
+    if not os.path.exists(checkpoint_file_name):
+        return None
+    with open(checkpoint_file_name) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+# Writes the checkpoint to a temporary file next to it and moves it in place, so a crash leaves either the old or
+# the new checkpoint, never a partial one
+def save_checkpoint(checkpoint_file_name, checkpoint):
+    directory = os.path.dirname(os.path.abspath(checkpoint_file_name))
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'w') as temp_file:
+        json.dump(checkpoint, temp_file)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, checkpoint_file_name)
+
+
+# Prints the throughput of a phase every interval seconds and when it ends, in bundles as well with bundles=True
+class PhaseProgress:
+    def __init__(self, phase, interval=10, out=print, bundles=True):
+        self.phase = phase
+        self.interval = interval
+        self.out = out
+        self.count_bundles = bundles
+        self.records = 0
+        self.bundles = 0
+        self._start = time.perf_counter()
+        self._last_print = self._start
+
+    def update(self, records, bundles=0):
+        self.records += records
+        self.bundles += bundles
+        now = time.perf_counter()
+        if now - self._last_print >= self.interval:
+            self._last_print = now
+            self.print(now)
+
+    def end(self):
+        self.print(time.perf_counter(), ' done')
+
+    def print(self, now, suffix=''):
+        seconds = max(now - self._start, 1e-9)
+        line = f'{self.phase:<8} {self.records:>10} records {self.records / seconds:>10.1f} records/s '
+        if self.count_bundles:
+            line += f'{self.bundles:>7} bundles {self.bundles / seconds:>8.2f} bundles/s '
+        self.out(f'{line}{seconds:>9.1f}s{suffix}')
+
+
+# Yields (bundle base name, offset after the record, record) for the records convert returns for each bundle,
+# starting at the offset of the checkpoint in its bundle and skipping the bundles before it. The bundles are known
+# by their base name, so a load resumed with the directory spelled differently (e.g. ./bundles for bundles) finds
+# its place. A checkpointed bundle that isn't in file_names is an error.
+def bundle_positions(convert, file_names, checkpoint, processes, *args):
+    names = [os.path.basename(file_name) for file_name in file_names]
+    start = 0
+    if checkpoint['bundle'] is not None:
+        if os.path.basename(checkpoint['bundle']) not in names:
+            raise Exception(f'The checkpointed bundle {checkpoint["bundle"]} is not in the bundle directory, '
+                            f'restart to load it again')
+        start = names.index(os.path.basename(checkpoint['bundle']))
+    items = [(file_name, None) + args for file_name in file_names[start:]]
+    for index, records in enumerate(convert_bundles(convert, items, processes)):
+        name = names[start + index]
+        offset = checkpoint['offset'] if index == 0 and checkpoint['bundle'] is not None else 0
+        for record_index in range(offset, len(records)):
+            yield name, record_index + 1, records[record_index]
+
+
+# The positions of the node records, without the Date nodes already written by this run. Dates written before a
+# restart are merged again, which is harmless. With a resolver, the resources are added to it.
+def node_positions(positions, seen_dates, resolver=None):
+    for file_name, offset, record in positions:
+        if record['labels'] == [date_label]:
+            date = record['properties']['id']
+            if date in seen_dates:
+                continue
+            seen_dates.add(date)
+        elif resolver is not None:
+            resolver.add_node_records([record])
+        yield file_name, offset, record
+
+
+# The positions of the edge records resolved by the resolver (see FHIR_references), followed by the ones resolved
+# on its deferred pass at the last position
+def resolved_positions(positions, resolver):
+    position = None
+    for file_name, offset, record in positions:
+        position = (file_name, offset)
+        for resolved in resolver.resolve_records([record]):
+            yield file_name, offset, resolved
+    for record in resolver.resolve_deferred():
+        yield position + (record,)
+
+
+# Writes the records of the positions batch_size at a time, each batch in a single transaction grouped by
+# statement, and saves the checkpoint after each one
+def ingest_records(graph, positions, record_batch, checkpoint, checkpoint_file_name, batch_size, progress):
+    phase = checkpoint['phase']
+    pending = {}
+    pending_count = 0
+    bundles = 0
+    position = None
+
+    def commit():
+        result, runtime = graph.write_transaction([(cypher, {'rows': rows}) for cypher, rows in pending.items()])
+        checkpoint['bundle'], checkpoint['offset'] = position
+        checkpoint['counts'][phase] += pending_count
+        checkpoint['runtime'][phase] += runtime
+        save_checkpoint(checkpoint_file_name, checkpoint)
+        progress.update(pending_count, bundles)
+
+    for file_name, offset, record in positions:
+        if position is not None and file_name != position[0]:
+            bundles += 1
+        position = (file_name, offset)
+        cypher, row = record_batch(record)
+        pending.setdefault(cypher, []).append(row)
+        pending_count += 1
+        if pending_count >= batch_size:
+            commit()
+            pending = {}
+            pending_count = 0
+            bundles = 0
+    if position is not None:
+        bundles += 1
+    if pending_count > 0:
+        commit()
+    elif bundles > 0:
+        progress.update(0, bundles)
+
+
+def next_phase(checkpoint, checkpoint_file_name, phase):
+    checkpoint['phase'] = phase
+    checkpoint['bundle'] = None
+    checkpoint['offset'] = 0
+    checkpoint['after'] = ''
+    save_checkpoint(checkpoint_file_name, checkpoint)
+
+
+# Loads the bundles in bundle_dir into the graph like FHIR_pipeline.load_bundles, resuming from the checkpoint in
+# checkpoint_file_name if there is one. A checkpoint of another bundle directory or date_nodes setting is an error,
+# unless restart=True. Returns the counts and the database runtime of each phase, over all the runs of the load.
+# With a resolver (see FHIR_references.ReferenceResolver) the edges are resolved as load_bundles does it, and the
+# counts of the references of this run are returned under 'references'. When the nodes were loaded by an earlier
+# run, the bundles are read once more to add their resources to the resolver.
+def ingest_bundles(graph, bundle_dir, checkpoint_file_name, batch_size=1000, processes=1, date_nodes=False,
+                   neighbor_context=True, projection=None, restart=False, progress_interval=10, out=print,
+                   resolver=None):
+    checkpoint = None if restart else load_checkpoint(checkpoint_file_name)
+    if checkpoint is None:
+        checkpoint = new_checkpoint(bundle_dir, date_nodes)
+        save_checkpoint(checkpoint_file_name, checkpoint)
+    elif checkpoint['bundle_dir'] != os.path.abspath(bundle_dir) or checkpoint['date_nodes'] != date_nodes:
+        raise Exception(f'{checkpoint_file_name} is the checkpoint of another load ({checkpoint["bundle_dir"]}, '
+                        f'date_nodes={checkpoint["date_nodes"]}), restart to replace it')
+    elif checkpoint['phase'] == 'done':
+        out(f'{bundle_dir} is already loaded, restart to load it again')
+    else:
+        out(f'Resuming {checkpoint["phase"]} from {checkpoint["bundle"] or checkpoint["after"] or "the start"}'
+            f'{" at offset " + str(checkpoint["offset"]) if checkpoint["bundle"] else ""}')
+
+    file_names = [file_name for file_name in bundle_file_names(bundle_dir)
+                  if os.path.abspath(file_name) != os.path.abspath(checkpoint_file_name)]
+
+    resources_added = False
+    if checkpoint['phase'] == 'nodes':
+        progress = PhaseProgress('nodes', progress_interval, out)
+        resources_added = checkpoint['bundle'] is None
+        positions = bundle_positions(bundle_node_records, file_names, checkpoint, processes, date_nodes, projection)
+        ingest_records(graph, node_positions(positions, set(), resolver), node_record_merge_batch, checkpoint,
+                       checkpoint_file_name, batch_size, progress)
+        progress.end()
+        next_phase(checkpoint, checkpoint_file_name, 'edges')
+
+    if checkpoint['phase'] == 'edges':
+        progress = PhaseProgress('edges', progress_interval, out)
+        if resolver is None:
+            positions = bundle_positions(bundle_edge_records, file_names, checkpoint, processes, date_nodes)
+        else:
+            if not resources_added:
+                resolver.add_bundles(file_names, processes)
+            positions = resolved_positions(
+                bundle_positions(bundle_edge_records, file_names, checkpoint, processes, date_nodes, True), resolver)
+        ingest_records(graph, positions, edge_record_merge_batch, checkpoint, checkpoint_file_name, batch_size,
+                       progress)
+        progress.end()
+        next_phase(checkpoint, checkpoint_file_name, 'context' if neighbor_context else 'done')
+
+    if checkpoint['phase'] == 'context':
+        progress = PhaseProgress('context', progress_interval, out, bundles=False)
+        start_count = checkpoint['counts']['context']
+
+        def on_batch(after, count):
+            progress.update(start_count + count - checkpoint['counts']['context'])
+            checkpoint['after'] = after
+            checkpoint['counts']['context'] = start_count + count
+            save_checkpoint(checkpoint_file_name, checkpoint)
+
+        count, runtime = graph.materialize_neighbor_context(batch_size=batch_size, after=checkpoint['after'],
+                                                            on_batch=on_batch)
+        checkpoint['runtime']['context'] += runtime
+        progress.end()
+        next_phase(checkpoint, checkpoint_file_name, 'done')
+
+    result = {
+        'bundles': len(file_names),
+        'nodes': checkpoint['counts']['nodes'],
+        'edges': checkpoint['counts']['edges'],
+        'neighbor_contexts': checkpoint['counts']['context'],
+        'runtime': sum(checkpoint['runtime'].values())
+    }
+    if resolver is not None:
+        result['references'] = resolver.stats()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load a directory of FHIR bundles into Neo4j, resuming an '
+                                                 'interrupted load from its checkpoint.')
+    parser.add_argument('bundle_dir')
+    parser.add_argument('--checkpoint', default='ingest_checkpoint.json')
+    parser.add_argument('--url', default=os.getenv('NEO4J_URL'))
+    parser.add_argument('--user', default=os.getenv('NEO4J_USER'))
+    parser.add_argument('--password', default=os.getenv('NEO4J_PASSWORD'))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--date-nodes', action='store_true', help='also create a Date node for every day')
+    parser.add_argument('--no-neighbor-context', action='store_true', help='skip materializing the neighbor context')
+    parser.add_argument('--blob-dir', help='keep large payloads off the nodes, in a blob store in this directory')
+    parser.add_argument('--resolve-references', action='store_true',
+                        help='resolve the references to resource ids before writing the edges')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and load from the start')
+    parser.add_argument('--progress-interval', type=float, default=10, help='seconds between progress lines')
+    args = parser.parse_args(argv)
+
+    projection = None
+    if args.blob_dir is not None:
+        projection = Projection(blob_store=BlobStore(args.blob_dir))
+    resolver = ReferenceResolver() if args.resolve_references else None
+
+    with Graph(args.url, args.user, args.password) as graph:
+        graph.ensure_schema()
+        result = ingest_bundles(graph, args.bundle_dir, args.checkpoint, args.batch_size, args.processes,
+                                args.date_nodes, not args.no_neighbor_context, projection, args.restart,
+                                args.progress_interval, resolver=resolver)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import json
+import math
+import time
+
+# Stages of ingest and retrieval that are measured
+json_parse_stage = 'json_parse'
+flatten_stage = 'flatten'
+text_conversion_stage = 'text_conversion'
+cypher_generation_stage = 'cypher_generation'
+db_write_stage = 'db_write'
+embedding_stage = 'embedding'
+retrieval_stage = 'retrieval'
+date_extraction_stage = 'date_extraction'
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+latency_buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, math.inf]
+
+
+class StageMetrics:
+    def __init__(self):
+        self.count = 0
+        self.items = 0
+        self.seconds = 0.0
+        self.min_seconds = math.inf
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(latency_buckets)
+
+    def observe(self, seconds, items=1):
+        self.count += 1
+        self.items += items
+        self.seconds += seconds
+        self.min_seconds = min(self.min_seconds, seconds)
+        self.max_seconds = max(self.max_seconds, seconds)
+        for i, bound in enumerate(latency_buckets):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'items': self.items,
+            'seconds': self.seconds,
+            'min_seconds': self.min_seconds if self.count > 0 else None,
+            'max_seconds': self.max_seconds,
+            'mean_seconds': self.seconds / self.count if self.count > 0 else None,
+            'buckets': {str(bound): count for bound, count in zip(latency_buckets, self.buckets)}
+        }
+
+
+# Times the body of a with statement and records it for a stage. items can be set inside the body,
+# e.g. to the number of rows written by a batch.
+class StageTimer:
+    def __init__(self, metrics, stage, items=1):
+        self._metrics = metrics
+        self._stage = stage
+        self._start = None
+        self.items = items
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.record(self._stage, time.perf_counter() - self._start, self.items)
+
+
+# Returned by Metrics.stage when metrics are disabled, so nothing is timed or recorded
+class NoStageTimer:
+    items = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+no_stage_timer = NoStageTimer()
+
+
+# Counters and latency histograms per stage, timed with a monotonic clock. Disabled by default: instrumented
+# code checks enabled before doing anything, so there is nothing to pay when metrics are off.
+# Stages can nest (e.g. flatten is also called during text_conversion) and metrics are kept per process.
+class Metrics:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stages = {}
+
+    def record(self, stage, seconds, items=1):
+        stage_metrics = self.stages.get(stage)
+        if stage_metrics is None:
+            stage_metrics = self.stages[stage] = StageMetrics()
+        stage_metrics.observe(seconds, items)
+
+    def stage(self, stage, items=1):
+        if not self.enabled:
+            return no_stage_timer
+        return StageTimer(self, stage, items)
+
+    def to_dict(self):
+        return {stage: self.stages[stage].to_dict() for stage in sorted(self.stages)}
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent)
+
+    # Prometheus text exposition format
+    def to_prometheus(self, prefix='fhir_rag'):
+        lines = [
+            f'# HELP {prefix}_stage_seconds Latency of each stage.',
+            f'# TYPE {prefix}_stage_seconds histogram'
+        ]
+        for stage in sorted(self.stages):
+            stage_metrics = self.stages[stage]
+            cumulative = 0
+            for bound, count in zip(latency_buckets, stage_metrics.buckets):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stage_metrics.seconds!r}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stage_metrics.count}')
+        lines.append(f'# HELP {prefix}_stage_items_total Items (resources, rows, texts) processed by each stage.')
+        lines.append(f'# TYPE {prefix}_stage_items_total counter')
+        for stage in sorted(self.stages):
+            lines.append(f'{prefix}_stage_items_total{{stage="{stage}"}} {self.stages[stage].items}')
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics recorded by the conversion functions and Graph
+metrics = Metrics()
@@ -0,0 +1,253 @@
+import glob
+import json
+import os
+from collections import deque
+from multiprocessing import Pool
+
+from FHIR_metrics import metrics, json_parse_stage
+from FHIR_to_graph import resource_to_node, resource_to_edges, date_to_node, date_label, resource_hash, \
+    native_date_to_str
+from FHIR_to_string import FHIR_bundle_to_strings
+
+skipped_resource_types = ['Provenance']
+
+
+def bundle_file_names(bundle_dir, pattern='*.json'):
+    file_names = glob.glob(os.path.join(bundle_dir, pattern))
+    file_names.sort()
+    return file_names
+
+
+def read_bundle(bundle_file_name):
+    with open(bundle_file_name) as raw:
+        with metrics.stage(json_parse_stage):
+            return json.load(raw)
+
+
+# Yields the resources of one bundle at a time, so only a single bundle is ever held in memory
+def bundle_resources(file_names):
+    for bundle_file_name in file_names:
+        bundle = read_bundle(bundle_file_name)
+        for entry in bundle['entry']:
+            resource = entry['resource']
+            if resource['resourceType'] not in skipped_resource_types:
+                yield resource
+
+
+# The node records for every resource in the bundle (or only the ones in resource_ids). With date_nodes=True
+# each one is followed by the node record of each of its dates the first time it appears in the bundle, taken from
+# the dates property of its node.
+# The content hash of each resource is stored with its node, for incremental loads. With a projection (see
+# FHIR_projection) it's the hash of the projected resource, so the values moved to the blob store are not hashed again.
+def bundle_node_records(bundle_file_name, resource_ids=None, date_nodes=False, projection=None):
+    records = []
+    bundle_dates = set()
+    for resource in bundle_resources([bundle_file_name]):
+        if resource_ids is not None and resource['id'] not in resource_ids:
+            continue
+        record = resource_to_node(resource, as_records=True, projection=projection, content_hash=True)
+        records.append(record)
+        if not date_nodes:
+            continue
+        for native_date in record['properties'].get('dates', []):
+            date = native_date_to_str(native_date)
+            if date not in bundle_dates:
+                bundle_dates.add(date)
+                records.append(date_to_node(date, as_records=True))
+    return records
+
+
+# The edge records of every resource in the bundle (or only the ones in resource_ids). With targets=True the
+# references are left as targets, for a FHIR_references.ReferenceResolver.
+def bundle_edge_records(bundle_file_name, resource_ids=None, date_nodes=False, targets=False):
+    records = []
+    for resource in bundle_resources([bundle_file_name]):
+        if resource_ids is not None and resource['id'] not in resource_ids:
+            continue
+        resource_edges, resource_dates = resource_to_edges(resource, as_records=True, date_nodes=date_nodes,
+                                                           targets=targets)
+        records += resource_edges
+    return records
+
+
+def bundle_strings(bundle_file_name):
+    return FHIR_bundle_to_strings(read_bundle(bundle_file_name))
+
+
+# The content hashes bundle_node_records stores for the resources of the bundle. The projection doesn't write to its
+# blob store here.
+def bundle_hashes(bundle_file_name, projection=None):
+    if projection is None:
+        return {resource['id']: resource_hash(resource) for resource in bundle_resources([bundle_file_name])}
+    projection = projection.without_blob_store()
+    return {resource['id']: resource_hash(projection.project(resource))
+            for resource in bundle_resources([bundle_file_name])}
+
+
+# Applies convert to each bundle and yields the results in bundle order. Each item is either a bundle file name
+# or a tuple of arguments for convert. With processes > 1 the bundles are converted in a pool of worker
+# processes, with at most max_pending bundles converted ahead of the consumer.
+def convert_bundles(convert, items, processes=1, max_pending=None):
+    if processes <= 1:
+        for item in items:
+            yield convert(*item) if type(item) is tuple else convert(item)
+        return
+
+    if max_pending is None:
+        max_pending = processes * 2
+    with Pool(processes) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(convert, item if type(item) is tuple else (item,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+
+# Yields the node records for every resource, and for every date the first time it is seen.
+# Dates are de-duplicated here, in bundle order, so the records are the same however many processes are used.
+# seen_dates only grows with the number of distinct days, not with the number of resources.
+# items are bundle file names, or (bundle file name, resource ids) to only convert some of the resources.
+# With a FHIR_references.ReferenceResolver, the resources are added to it as they stream through.
+def node_records(items, seen_dates=None, processes=1, date_nodes=False, projection=None, resolver=None):
+    if seen_dates is None:
+        seen_dates = set()
+    for records in convert_bundles(bundle_node_records, bundle_items(items, date_nodes, projection), processes):
+        if resolver is not None:
+            resolver.add_node_records(records)
+        yield from unique_dates(records, seen_dates)
+
+
+# The records of one bundle, without the Date nodes already in seen_dates
+def unique_dates(records, seen_dates):
+    for record in records:
+        if record['labels'] == [date_label]:
+            date = record['properties']['id']
+            if date in seen_dates:
+                continue
+            seen_dates.add(date)
+        yield record
+
+
+# With a FHIR_references.ReferenceResolver, the edges are yielded with the id of the resource they point to as
+# their end, followed by the ones it could resolve on its deferred pass
+def edge_records(items, processes=1, date_nodes=False, resolver=None):
+    if resolver is None:
+        for records in convert_bundles(bundle_edge_records, bundle_items(items, date_nodes), processes):
+            yield from records
+        return
+    for records in convert_bundles(bundle_edge_records, bundle_items(items, date_nodes, True), processes):
+        yield from resolver.resolve_records(records)
+    yield from resolver.resolve_deferred()
+
+
+# The arguments of bundle_node_records or bundle_edge_records for each item, followed by args
+def bundle_items(items, *args):
+    for item in items:
+        if type(item) is tuple:
+            yield item + args
+        else:
+            yield (item, None) + args
+
+
+# Yields (bundle file name, ids) for each bundle with resources that are new or whose content hash differs from
+# the one stored in the graph, and appends them to changed
+def changed_bundles(graph, file_names, changed, projection=None):
+    for bundle_file_name in file_names:
+        hashes = bundle_hashes(bundle_file_name, projection)
+        stored_hashes = graph.resource_hashes(list(hashes))
+        resource_ids = set(id for id in hashes if stored_hashes.get(id) != hashes[id])
+        if len(resource_ids) > 0:
+            changed.append((bundle_file_name, resource_ids))
+            yield bundle_file_name, resource_ids
+
+
+# Yields the (strings, patient name) of FHIR_bundle_to_strings for each bundle, in bundle order
+def bundles_to_strings(file_names, processes=1):
+    yield from convert_bundles(bundle_strings, file_names, processes)
+
+
+# Streams the bundles into the graph, holding at most window pending records at a time.
+# The bundles are read twice: first for the nodes, then for the edges. That way an edge can point at a
+# node from any bundle (e.g. the practitioner bundle) without keeping the edges of the whole corpus around.
+# With processes > 1 the conversion of the bundles is spread over that many worker processes.
+# With a chunker (FHIR_chunking.Chunker), the Chunk nodes of the resources are created once their nodes are loaded.
+# With incremental=True, only the resources that are new or changed since the last load are written: their nodes
+# are upserted with MERGE, and their outgoing edges (references and dates) are deleted and created again. Their
+# Chunk nodes are deleted, as their text is stale, and created again with the chunker.
+# Dates are stored as native date properties of the resources and edges. With date_nodes=True, a Date node is
+# also created for every day and linked to the resources with that date.
+# With neighbor_context=True, once the edges are loaded the bounded context of the neighbors of each resource is
+# stored on it (see Graph.materialize_neighbor_context), for retrieval to read instead of traversing.
+# With a projection (see FHIR_projection.Projection), large payloads are kept off the nodes.
+# With a resolver (see FHIR_references.ReferenceResolver), the references are resolved to the ids of the resources
+# they point to as the bundles are loaded, the edges are written as lookups by id, and the edges that point to no
+# loaded resource are not written but counted under 'references'.
+def load_bundles(graph, bundle_dir, batch_size=1000, window=10000, processes=1, incremental=False, date_nodes=False,
+                 neighbor_context=True, projection=None, resolver=None, chunker=None):
+    file_names = bundle_file_names(bundle_dir)
+    if incremental:
+        return load_changed_bundles(graph, file_names, batch_size, window, processes, date_nodes, neighbor_context,
+                                    projection, resolver, chunker)
+    node_count, node_runtime = graph.create_nodes(
+        node_records(file_names, processes=processes, date_nodes=date_nodes, projection=projection,
+                     resolver=resolver),
+        batch_size, window)
+    chunk_count, chunk_runtime = 0, 0
+    if chunker is not None:
+        chunk_count, chunk_runtime = chunker.load_chunks(graph, file_names, batch_size, window, processes)
+    edge_count, edge_runtime = graph.create_edges(
+        edge_records(file_names, processes=processes, date_nodes=date_nodes, resolver=resolver), batch_size, window)
+    context_count, context_runtime = 0, 0
+    if neighbor_context:
+        context_count, context_runtime = graph.materialize_neighbor_context(batch_size=batch_size)
+    result = {
+        'bundles': len(file_names),
+        'nodes': node_count,
+        'edges': edge_count,
+        'neighbor_contexts': context_count,
+        'chunks': chunk_count,
+        'runtime': node_runtime + chunk_runtime + edge_runtime + context_runtime
+    }
+    if resolver is not None:
+        result['references'] = resolver.stats()
+    return result
+
+
+# Only the changed resources stream through the node records, so with a resolver every bundle is read first to
+# add the unchanged resources their references can point to
+def load_changed_bundles(graph, file_names, batch_size=1000, window=10000, processes=1, date_nodes=False,
+                         neighbor_context=True, projection=None, resolver=None, chunker=None):
+    if resolver is not None:
+        resolver.add_bundles(file_names, processes)
+    changed = []
+    node_count, node_runtime = graph.merge_nodes(
+        node_records(changed_bundles(graph, file_names, changed, projection), processes=processes, date_nodes=date_nodes,
+                     projection=projection),
+        batch_size, window)
+    changed_ids = (id for bundle_file_name, resource_ids in changed for id in resource_ids)
+    deleted_count, delete_runtime = graph.delete_edges(changed_ids, batch_size)
+    changed_ids = (id for bundle_file_name, resource_ids in changed for id in resource_ids)
+    deleted_count, chunk_delete_runtime = graph.delete_chunks(changed_ids, batch_size)
+    chunk_count, chunk_runtime = 0, 0
+    if chunker is not None:
+        chunk_count, chunk_runtime = chunker.load_changed_chunks(graph, changed, batch_size, window, processes)
+    edge_count, edge_runtime = graph.create_edges(
+        edge_records(changed, processes=processes, date_nodes=date_nodes, resolver=resolver), batch_size, window)
+    context_count, context_runtime = 0, 0
+    if neighbor_context:
+        changed_ids = (id for bundle_file_name, resource_ids in changed for id in resource_ids)
+        context_count, context_runtime = graph.update_neighbor_context(changed_ids, batch_size=batch_size)
+    result = {
+        'bundles': len(file_names),
+        'changed_bundles': len(changed),
+        'nodes': node_count,
+        'edges': edge_count,
+        'neighbor_contexts': context_count,
+        'chunks': chunk_count,
+        'runtime': node_runtime + delete_runtime + chunk_delete_runtime + chunk_runtime + edge_runtime + context_runtime
+    }
+    if resolver is not None:
+        result['references'] = resolver.stats()
+    return result
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import tempfile
+
+# Projection of the resources before they are flattened into the properties of their nodes (see
+# FHIR_to_graph.resource_to_node), so large payloads never end up on the nodes, where they bloat the store, the page
+# cache and every MATCH that reads them. The base64 data of the attachments of DocumentReference and
+# DiagnosticReport (content_0_attachment_data and presentedForm_0_data once flattened) can be megabytes.
+#
+# The rules of each resource type are a dict of lists of field paths. A path is the names of the fields from the
+# resource down, separated by dots, with the lists in between left out (content.attachment.data is the data of the
+# attachment of every content).
+#   include  if given, only these fields of the resource are kept (resourceType and id always are)
+#   exclude  fields that are left out
+#   blob     fields that are always moved to the blob store, whatever their size
+# Besides, any string longer than max_value_size characters is moved to the blob store.
+#
+# A value moved to the blob store is replaced by {'blob': key, 'size': length}, which becomes the <field>_blob and
+# <field>_size properties of the node. The value can be read back with BlobStore.get(key). Without a blob store the
+# values are left out the same way (the key is still the hash of the value, so it can be found in the bundle).
+
+default_projection_rules = {
+    'DocumentReference': {'blob': ['content.attachment.data']},
+    'DiagnosticReport': {'blob': ['presentedForm.data']},
+}
+
+default_max_value_size = 16384
+
+
+# Content-addressed store of values, one file per value named after the sha256 of its content:
+#   <directory>/<first 2 characters of the key>/<key>
+# Storing the same value again does nothing, and a value is only visible once it has been completely written, so
+# several processes can store into the same directory.
+class BlobStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    # Stores data (a str is stored as utf-8) and returns its key
+    def put(self, data):
+        if type(data) is str:
+            data = data.encode('utf-8')
+        key = blob_key(data)
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(handle, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        return key
+
+    def get(self, key, as_text=True):
+        with open(self.path(key), 'rb') as blob_file:
+            data = blob_file.read()
+        return data.decode('utf-8') if as_text else data
+
+
+def blob_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Whether there is a string longer than max_value_size anywhere in value
+def has_large_value(value, max_value_size):
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if type(value) is dict:
+            stack.extend(value.values())
+        elif type(value) is list:
+            stack.extend(value)
+        elif type(value) is str and len(value) > max_value_size:
+            return True
+    return False
+
+
+# {field: sub tree} for the paths of a rule, with True for the fields the paths end at
+def path_tree(paths):
+    tree = {}
+    for path in paths:
+        node = tree
+        fields = path.split('.')
+        for field in fields[:-1]:
+            child = node.setdefault(field, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[fields[-1]] = True
+    return tree
+
+
+class Projection:
+    def __init__(self, rules=None, max_value_size=default_max_value_size, blob_store=None):
+        self.rules = default_projection_rules if rules is None else rules
+        self.max_value_size = max_value_size
+        self.blob_store = blob_store
+        self._trees = {resource_type: (set(rule['include']) | {'resourceType', 'id'} if 'include' in rule else None,
+                                       path_tree(rule.get('exclude', [])), path_tree(rule.get('blob', [])))
+                       for resource_type, rule in self.rules.items()}
+
+    # The same projection without the blob store: the values are left out the same way, under the same keys, but
+    # never written, e.g. to find the keys or the content hashes of resources without storing their values again
+    def without_blob_store(self):
+        if self.blob_store is None:
+            return self
+        return Projection(self.rules, self.max_value_size)
+
+    def blob(self, value):
+        data = str(value).encode('utf-8')
+        if self.blob_store is not None:
+            key = self.blob_store.put(data)
+        else:
+            key = blob_key(data)
+        return {'blob': key, 'size': len(data)}
+
+    # The resource as it should be put on its node. Only the dicts and lists that change are copied, an unchanged
+    # resource is returned as it is.
+    def project(self, resource):
+        trees = self._trees.get(resource['resourceType'])
+        if trees is None:
+            if not has_large_value(resource, self.max_value_size):
+                return resource
+            trees = (None, None, None)
+        include, exclude, blob = trees
+        projected = None
+        for field, value in resource.items():
+            if include is not None and field not in include:
+                new_value = None
+            else:
+                new_value = self.project_value(value, exclude.get(field) if exclude else None,
+                                               blob.get(field) if blob else None)
+            if new_value is not value and projected is None:
+                projected = {}
+                for previous_field, previous_value in resource.items():
+                    if previous_field == field:
+                        break
+                    projected[previous_field] = previous_value
+            if projected is not None and new_value is not None:
+                projected[field] = new_value
+        return resource if projected is None else projected
+
+    # The projection of a value, None if it's left out. exclude and blob are the sub trees of the rules for the
+    # value, True if the rule ends at it.
+    def project_value(self, value, exclude, blob):
+        if exclude is True:
+            return None
+        if blob is True:
+            return self.blob(value)
+        if type(value) is str:
+            if len(value) > self.max_value_size:
+                return self.blob(value)
+            return value
+        if type(value) is dict:
+            changed = None
+            for field, item in value.items():
+                new_item = self.project_value(item, exclude.get(field) if exclude else None,
+                                              blob.get(field) if blob else None)
+                if new_item is not item:
+                    if changed is None:
+                        changed = dict(value)
+                    if new_item is None:
+                        del changed[field]
+                    else:
+                        changed[field] = new_item
+            return value if changed is None else changed
+        if type(value) is list:
+            changed = None
+            for i, item in enumerate(value):
+                new_item = self.project_value(item, exclude, blob)
+                if new_item is not item:
+                    if changed is None:
+                        changed = list(value)
+                    changed[i] = new_item
+            if changed is None:
+                return value
+            return [item for item in changed if item is not None]
+        return value
@@ -0,0 +1,164 @@
+import datetime
+import json
+import re
+from collections import OrderedDict
+
+from FHIR_metrics import metrics, date_extraction_stage
+
+# Preprocessing of the questions asked about the graph: finding the date a question is about, as the MM/DD/YYYY
+# key of the Date nodes (see FHIR_to_graph.extract_date), or 'none' when there is none.
+#
+# The common ways of writing a date ("Jan. 18, 2014", "2/9/2014", "March 6, 1978", "18 January 2014",
+# "2014-01-18") are parsed with regular expressions. Only the questions the rules can't decide (a form they don't
+# know, or several different dates) are sent to the LLM, and questions without any digit or month name are known
+# to have no date. The answers are kept in a LRU cache, so asking the same question again costs nothing.
+
+no_date = 'none'
+
+month_numbers = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6, 'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10,
+                 'nov': 11, 'dec': 12}
+month_pattern = r'(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|' \
+                r'oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\.?'
+day_pattern = r'(\d{1,2})(?:st|nd|rd|th)?'
+
+iso_date_pattern = re.compile(r'\b(\d{4})[-/](\d{1,2})[-/](\d{1,2})\b')
+numeric_date_pattern = re.compile(r'\b(\d{1,2})[-/](\d{1,2})[-/](\d{4}|\d{2})\b')
+month_day_year_pattern = re.compile(r'\b' + month_pattern + r'\s+' + day_pattern + r',?\s+(\d{4})\b', re.IGNORECASE)
+day_month_year_pattern = re.compile(r'\b' + day_pattern + r'\s+(?:of\s+)?' + month_pattern + r',?\s+(\d{4})\b',
+                                    re.IGNORECASE)
+date_hint_pattern = re.compile(r'\d|\b' + month_pattern + r'(?!\w)', re.IGNORECASE)
+json_object_pattern = re.compile(r'\{[^{}]*\}')
+
+date_prompt = '''
+    system:Given the following question from the user, extract the date the question is asking about.
+    Return the answer formatted as JSON only, as a single line.
+    Use the form:
+
+    {{"date":"[THE DATE IN THE QUESTION]"}}
+
+    Use the date format of month/day/year.
+    Use two digits for the month and day.
+    Use four digits for the year.
+    So 3/4/23 should be returned as {{"date":"03/04/2023"}}.
+    So 04/14/89 should be returned as {{"date":"04/14/1989"}}.
+
+    Please do not include any special formatting characters, like new lines or "\\n".
+    Please do not include the word "json".
+    Please do not include triple quotes.
+
+    If there is no date, do not make one up.
+    If there is no date return the word "none", like: {{"date":"none"}}
+
+    user:{question}
+    '''
+
+
+# Two digit years are in the last hundred years, so 89 is 1989 and 23 is 2023
+def full_year(year):
+    if len(year) == 4:
+        return int(year)
+    year = int(year)
+    century = datetime.date.today().year // 100 * 100
+    return century + year if century + year <= datetime.date.today().year else century - 100 + year
+
+
+def date_key(year, month, day):
+    try:
+        date = datetime.date(year, month, day)
+    except ValueError:
+        return None
+    return f'{date.month:02d}/{date.day:02d}/{date.year:04d}'
+
+
+# The keys of the dates written in the text, in the order they are found, without duplicates
+def find_date_keys(text):
+    keys = []
+    for match in iso_date_pattern.finditer(text):
+        keys.append((match.start(), date_key(int(match[1]), int(match[2]), int(match[3]))))
+    for match in numeric_date_pattern.finditer(text):
+        keys.append((match.start(), date_key(full_year(match[3]), int(match[1]), int(match[2]))))
+    for match in month_day_year_pattern.finditer(text):
+        keys.append((match.start(), date_key(int(match[3]), month_numbers[match[1][:3].lower()], int(match[2]))))
+    for match in day_month_year_pattern.finditer(text):
+        keys.append((match.start(), date_key(int(match[3]), month_numbers[match[2][:3].lower()], int(match[1]))))
+    keys.sort()
+    return list(dict.fromkeys(key for start, key in keys if key is not None))
+
+
+# The key of the date of the question found by the rules, no_date if it has no date, None if the rules can't tell
+def rule_date_for_question(question):
+    keys = find_date_keys(question)
+    if len(keys) == 1:
+        return keys[0]
+    if len(keys) == 0 and date_hint_pattern.search(question) is None:
+        return no_date
+    return None
+
+
+# The date in the answer of the LLM to date_prompt. Answers that are not the JSON asked for (extra text, several
+# lines, another date format) are read as well as they can be, and no_date is returned when there is no date in them.
+def parse_date_response(response):
+    for json_str in json_object_pattern.findall(response):
+        try:
+            date_str = str(json.loads(json_str).get('date', no_date))
+        except (ValueError, AttributeError):
+            continue
+        if date_str.strip().lower() == no_date:
+            return no_date
+        keys = find_date_keys(date_str)
+        if len(keys) > 0:
+            return keys[0]
+    keys = find_date_keys(response)
+    if len(keys) > 0:
+        return keys[0]
+    return no_date
+
+
+# Asks the LLM (any callable from prompt to completion, e.g. langchain's Ollama(model=...)) for the date of the
+# question
+def llm_date_for_question(question, llm):
+    return parse_date_response(llm(date_prompt.format(question=question)))
+
+
+# Returns the key of the date a question is about (or no_date), from the rules or else from the LLM, and keeps the
+# last cache_size answers. Without an llm the questions the rules can't decide have no date.
+#   date_for_question = QuestionDateExtractor(Ollama(model=ollama_model))
+#   date_for_question('What was the blood pressure on Jan. 18, 2014?')  # '01/18/2014'
+class QuestionDateExtractor:
+    def __init__(self, llm=None, cache_size=1024):
+        self.llm = llm
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.rule_answers = 0
+        self.llm_answers = 0
+
+    def __call__(self, question):
+        key = question.strip()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return self._cache[key]
+
+        with metrics.stage(date_extraction_stage):
+            date = rule_date_for_question(key)
+            if date is not None:
+                self.rule_answers += 1
+            elif self.llm is not None:
+                date = llm_date_for_question(key, self.llm)
+                self.llm_answers += 1
+            else:
+                date = no_date
+                self.rule_answers += 1
+
+        self._cache[key] = date
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return date
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'rule_answers': self.rule_answers, 'llm_answers': self.llm_answers,
+                'cached': len(self._cache)}
@@ -0,0 +1,145 @@
+from FHIR_pipeline import bundle_resources, convert_bundles
+from FHIR_to_graph import resource_label, id_to_key, identifier_target
+
+# Resolution of references on ingest, so every edge is written as a lookup of the id of its end through the
+# resource_id constraint (see Graph.ensure_schema), instead of matching the end by the properties its reference
+# names (e.g. the NPI of a Practitioner) for every edge.
+#
+# While the node records stream through (see FHIR_pipeline.node_records), the ReferenceResolver keeps the id of
+# every resource and the id of each of its identifiers (system and value). The edge records are then returned with
+# the target of their reference (resource_to_edges(resource, as_records=True, targets=True)), which the resolver
+# turns into the id of the resource it points to.
+# An edge whose target isn't known yet is queued for a deferred pass (resolve_deferred), when more resources may
+# have been added. What can't be resolved then is dangling: it isn't written, and is counted by kind of target (id,
+# or the system of the identifier) in stats(), along with the references to contained resources and the ones that
+# couldn't be read.
+
+
+# The targets a resource can be referenced by, other than its id: each of its identifiers
+def resource_identifier_targets(resource):
+    identifiers = resource.get('identifier', [])
+    if type(identifiers) is dict:
+        identifiers = [identifiers]
+    return [identifier_target(identifier) for identifier in identifiers if 'value' in identifier]
+
+
+# [(id, identifier targets)] of the resources of a bundle, for ReferenceResolver.add_bundles
+def bundle_reference_targets(bundle_file_name):
+    return [(resource['id'], resource_identifier_targets(resource)) for resource in bundle_resources([bundle_file_name])]
+
+
+# The targets of the identifiers of a node record, from its flattened identifier_<i>_system and identifier_<i>_value
+# properties. The fields a projection leaves out of the node are not there, so a resource whose identifiers are
+# left out can only be referenced by id.
+def node_record_identifier_targets(properties):
+    targets = []
+    i = 0
+    while f'identifier_{i}_value' in properties:
+        targets.append(('identifier', properties.get(f'identifier_{i}_system', ''), properties[f'identifier_{i}_value']))
+        i += 1
+    return targets
+
+
+class ReferenceResolver:
+    def __init__(self):
+        self.ids = set()
+        self.identifiers = {}
+        self._deferred = []
+        self.resolved = 0
+        self.resolved_deferred = 0
+        self.contained = 0
+        self.unrecognized = 0
+
+    def add(self, id, identifier_targets=()):
+        self.ids.add(id)
+        for target in identifier_targets:
+            self.identifiers[target] = id
+
+    def add_resource(self, resource):
+        self.add(resource['id'], resource_identifier_targets(resource))
+
+    # Adds the resources of node records (see FHIR_to_graph.resource_to_node), skipping the Date nodes
+    def add_node_records(self, records):
+        for record in records:
+            if resource_label in record['labels']:
+                properties = record['properties']
+                self.add(properties['id'], node_record_identifier_targets(properties))
+
+    # Adds every resource of the bundles, e.g. before loading only some of them (an incremental load, or a load
+    # resumed after its nodes). Reads the bundles without converting them. Returns the number of resources added.
+    def add_bundles(self, file_names, processes=1):
+        count = 0
+        for bundle_targets in convert_bundles(bundle_reference_targets, file_names, processes):
+            for id, identifier_targets in bundle_targets:
+                self.add(id, identifier_targets)
+            count += len(bundle_targets)
+        return count
+
+    # The id of the resource a target (see FHIR_to_graph.reference_target) points to, None if it isn't known
+    def resolve(self, target):
+        if target[0] == 'id':
+            return target[1] if target[1] in self.ids else None
+        elif target[0] == 'identifier':
+            return self.identifiers.get(target)
+        return None
+
+    # Yields the edge records with the id of the resource their target points to as their end. The edges to
+    # targets that aren't known yet are queued for resolve_deferred, and the ones to contained resources or with
+    # references that can't be read are counted and dropped.
+    def resolve_records(self, records):
+        for record in records:
+            target = record.get('target')
+            if target is None:
+                yield record
+            elif target[0] == 'contained':
+                self.contained += 1
+            elif target[0] == 'unrecognized':
+                self.unrecognized += 1
+            else:
+                id = self.resolve(target)
+                if id is None:
+                    self._deferred.append(record)
+                else:
+                    self.resolved += 1
+                    yield resolved_record(record, id)
+
+    # Yields the queued edge records whose target is known now. The others stay queued, as dangling.
+    def resolve_deferred(self):
+        deferred = self._deferred
+        self._deferred = []
+        for record in deferred:
+            id = self.resolve(record['target'])
+            if id is None:
+                self._deferred.append(record)
+            else:
+                self.resolved_deferred += 1
+                yield resolved_record(record, id)
+
+    # The queued edge records that couldn't be resolved yet
+    def dangling(self):
+        return list(self._deferred)
+
+    def stats(self):
+        dangling_targets = {}
+        for record in self._deferred:
+            target = record['target']
+            kind = target[0] if target[0] == 'id' else target[1]
+            dangling_targets[kind] = dangling_targets.get(kind, 0) + 1
+        return {
+            'resources': len(self.ids),
+            'identifiers': len(self.identifiers),
+            'resolved': self.resolved,
+            'resolved_deferred': self.resolved_deferred,
+            'dangling': len(self._deferred),
+            'dangling_targets': dangling_targets,
+            'contained': self.contained,
+            'unrecognized': self.unrecognized
+        }
+
+
+def resolved_record(record, id):
+    record = dict(record)
+    del record['target']
+    record['end_label'] = resource_label
+    record['end'] = id_to_key(id)
+    return record
@@ -0,0 +1,111 @@
+import datetime
+
+from FHIR_metrics import metrics, retrieval_stage
+
+# Vector search over the resource nodes that is restricted to a date or a range of dates.
+#
+# The resources store their dates as native DATE properties (dates, date_min and date_max, see
+# FHIR_to_graph.resource_to_node) and date_min and date_max have range indexes (see Graph.ensure_schema). The date
+# filter is an index seek that runs before any vector is scored, so the nodes found don't depend on how many
+# other nodes are closer to the question, as they do when the filter is applied to the results of the vector index.
+
+# Cypher that turns each node found, and its score, into the text of the primary entry followed by the neighbor
+# context stored on it at ingest time (see Graph.materialize_neighbor_context)
+context_cypher = '''
+    RETURN "Primary Entry:\\n" + node.text + coalesce(node.neighbor_context, "") AS text, score, node.id AS id
+    ORDER BY score DESC
+'''
+
+# Same as context_cypher, but traversing to every neighbor of each node found at query time
+traversal_context_cypher = '''
+    OPTIONAL MATCH (node)<-[]->(sc:resource)
+    WITH node, score, collect(DISTINCT sc.text) AS secondary
+    RETURN "Primary Entry:\\n" + node.text + reduce(s = "", item IN secondary | s + "\\n\\nSecondary Entry:\\n" + item) AS text,
+           score, node.id AS id
+    ORDER BY score DESC
+'''
+
+no_context_cypher = '''
+    RETURN node.text AS text, score, node.id AS id
+    ORDER BY score DESC
+'''
+
+date_search_cypher = '''
+    MATCH (node:resource)
+    WHERE node.date_min <= $end AND node.date_max >= $start
+      AND node.embedding IS NOT NULL
+      AND any(date IN node.dates WHERE $start <= date <= $end)
+    WITH node, vector.similarity.cosine(node.embedding, $embedding) AS score
+    ORDER BY score DESC
+    LIMIT $k
+'''
+
+vector_search_cypher = '''
+    CALL db.index.vector.queryNodes($index_name, $k, $embedding) YIELD node, score
+'''
+
+# Vector search over the Chunk nodes (see FHIR_chunking) that returns the resources of the chunks found, each with
+# the score of its best chunk. More chunks than resources are asked for, as several can be of the same resource.
+chunk_search_cypher = '''
+    CALL db.index.vector.queryNodes($index_name, $chunk_k, $embedding) YIELD node AS chunk, score
+    MATCH (chunk)-[:chunk_of]->(node:resource)
+    WITH node, max(score) AS score
+    ORDER BY score DESC
+    LIMIT $k
+'''
+
+
+# Parses the MM/DD/YYYY dates returned by date_for_question in FHIR_GRAPHS.ipynb. Returns None for "none"
+# or anything else that is not a date.
+def question_date(date_str):
+    try:
+        return datetime.datetime.strptime(date_str.strip(), '%m/%d/%Y').date()
+    except (ValueError, AttributeError):
+        return None
+
+
+def select_return_cypher(with_context, traverse):
+    if not with_context:
+        return no_context_cypher
+    elif traverse:
+        return traversal_context_cypher
+    return context_cypher
+
+
+# Returns (text, score, id) of the k resources most similar to embedding, best first. If start and/or end are given,
+# only resources with a date between them (inclusive) are scored. Without dates the vector index is used.
+# With traverse=True the context is built from the neighbors at query time rather than read from the node.
+def search_resources(graph, embedding, k=5, start=None, end=None, index_name='fhir_text', with_context=True,
+                     traverse=False):
+    return_cypher = select_return_cypher(with_context, traverse)
+    with metrics.stage(retrieval_stage):
+        if start is None and end is None:
+            result, runtime = graph.query(vector_search_cypher + return_cypher,
+                                          {'index_name': index_name, 'k': k, 'embedding': embedding})
+        else:
+            result, runtime = graph.query(date_search_cypher + return_cypher, {
+                'start': start if start is not None else datetime.date.min,
+                'end': end if end is not None else datetime.date.max,
+                'k': k,
+                'embedding': embedding
+            })
+        return result
+
+
+# Same as search_resources, for a question and an embedder with embed_query (e.g. HuggingFaceBgeEmbeddings)
+def search_question(graph, embedder, question, k=5, start=None, end=None, index_name='fhir_text', with_context=True,
+                    traverse=False):
+    return search_resources(graph, embedder.embed_query(question), k, start, end, index_name, with_context, traverse)
+
+
+# Same as search_resources, over the embeddings of the chunks of the resources (see FHIR_chunking.load_chunks) and
+# without date filter: returns (text, score, id) of the k resources with the chunks most similar to embedding.
+# chunks_per_resource is how many chunks are searched for each resource returned.
+def search_chunks(graph, embedding, k=5, index_name='fhir_chunks', with_context=True, traverse=False,
+                  chunks_per_resource=4):
+    return_cypher = select_return_cypher(with_context, traverse)
+    with metrics.stage(retrieval_stage):
+        result, runtime = graph.query(chunk_search_cypher + return_cypher, {
+            'index_name': index_name, 'k': k, 'chunk_k': k * chunks_per_resource, 'embedding': embedding
+        })
+        return result
@@ -0,0 +1,379 @@
+import base64
+import datetime
+import json
+import os
+import random
+import uuid
+
+# Seeded generator of bundles shaped like the ones Synthea writes: one bundle per patient, plus a
+# hospitalInformation bundle (Organizations and Locations) and a practitionerInformation bundle
+# (Practitioners and PractitionerRoles) that the patient bundles reference by identifier.
+
+synthea_system = 'https://github.com/synthetichealth/synthea'
+npi_system = 'http://hl7.org/fhir/sid/us-npi'
+snomed_system = 'http://snomed.info/sct'
+loinc_system = 'http://loinc.org'
+
+given_names = ['Alfonso', 'Ashley', 'Arnold', 'Maria', 'Kenji', 'Fatima', 'Olga', 'Samuel', 'Priya', 'Liam']
+family_names = ['Bins', 'Bergstrom', 'Wilkinson', 'Okafor', 'Nakamura', 'Haddad', 'Ivanova', 'Garcia']
+
+encounter_types = [
+    ('185349003', 'Encounter for check up (procedure)'),
+    ('185345009', 'Encounter for symptom (procedure)'),
+    ('410620009', 'Well child visit (procedure)'),
+    ('50849002', 'Emergency room admission (procedure)'),
+]
+
+vital_signs = [
+    ('8302-2', 'Body Height', 'cm', 150, 190),
+    ('29463-7', 'Body Weight', 'kg', 50, 110),
+    ('39156-5', 'Body mass index (BMI) [Ratio]', 'kg/m2', 18, 35),
+    ('8867-4', 'Heart rate', '/min', 55, 100),
+    ('9279-1', 'Respiratory rate', '/min', 12, 20),
+]
+
+procedures = [
+    ('73761001', 'Colonoscopy'),
+    ('430193006', 'Medication Reconciliation (procedure)'),
+    ('710824005', 'Assessment of health and social care needs (procedure)'),
+    ('428191000124101', 'Documentation of current medications'),
+]
+
+payers = ['Medicaid', 'Medicare', 'Blue Cross Blue Shield', 'NO_INSURANCE']
+
+
+class SyntheticConfig:
+    def __init__(self, patients=10, encounters_per_patient=10, observations_per_encounter=4, claim_items=6,
+                 document_size=4096, organizations=3, practitioners_per_organization=4, seed=0):
+        self.patients = patients
+        self.encounters_per_patient = encounters_per_patient
+        self.observations_per_encounter = observations_per_encounter
+        self.claim_items = claim_items
+        self.document_size = document_size
+        self.organizations = organizations
+        self.practitioners_per_organization = practitioners_per_organization
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class SyntheticPopulation:
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.organizations = []
+        self.practitioners = []
+        for i in range(config.organizations):
+            organization = {'id': self.uuid(), 'location_id': self.uuid(), 'name': f'Hospital {i}'}
+            self.organizations.append(organization)
+            for j in range(config.practitioners_per_organization):
+                self.practitioners.append({
+                    'id': self.uuid(),
+                    'npi': str(9999900000 + len(self.practitioners)),
+                    'given': self.rng.choice(given_names) + str(self.rng.randint(1, 999)),
+                    'family': self.rng.choice(family_names) + str(self.rng.randint(1, 999)),
+                    'organization': organization
+                })
+
+    def uuid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128)))
+
+    def date_time(self, start_year=1960, end_year=2023):
+        start = datetime.datetime(start_year, 1, 1)
+        seconds = self.rng.randint(0, int((datetime.datetime(end_year, 12, 31) - start).total_seconds()))
+        return start + datetime.timedelta(seconds=seconds)
+
+    @staticmethod
+    def fhir_date_time(value):
+        return value.strftime('%Y-%m-%dT%H:%M:%S-05:00')
+
+    @staticmethod
+    def coding(system, code, display):
+        return {'coding': [{'system': system, 'code': code, 'display': display}], 'text': display}
+
+    @staticmethod
+    def organization_reference(organization):
+        return {'reference': f'Organization?identifier={synthea_system}|{organization["id"]}',
+                'display': organization['name']}
+
+    @staticmethod
+    def location_reference(organization):
+        return {'reference': f'Location?identifier={synthea_system}|{organization["location_id"]}',
+                'display': organization['name']}
+
+    @staticmethod
+    def practitioner_reference(practitioner):
+        return {'reference': f'Practitioner?identifier={npi_system}|{practitioner["npi"]}',
+                'display': f'Dr. {practitioner["given"]} {practitioner["family"]}'}
+
+    def patient(self):
+        given = self.rng.choice(given_names) + str(self.rng.randint(1, 999))
+        family = self.rng.choice(family_names) + str(self.rng.randint(1, 999))
+        return {
+            'resourceType': 'Patient',
+            'id': self.uuid(),
+            'meta': {'profile': ['http://hl7.org/fhir/us/core/StructureDefinition/us-core-patient']},
+            'text': {'status': 'generated', 'div': '<div xmlns="http://www.w3.org/1999/xhtml">Generated by Synthea.</div>'},
+            'extension': [{'url': 'http://hl7.org/fhir/StructureDefinition/patient-birthPlace',
+                           'valueAddress': {'city': 'Boston', 'state': 'Massachusetts', 'country': 'US'}}],
+            'identifier': [{'system': synthea_system, 'value': self.uuid()}],
+            'name': [{'use': 'official', 'family': family, 'given': [given], 'prefix': ['Mr.']}],
+            'telecom': [{'system': 'phone', 'value': f'555-{self.rng.randint(100, 999)}-{self.rng.randint(1000, 9999)}', 'use': 'home'}],
+            'gender': self.rng.choice(['male', 'female']),
+            'birthDate': self.date_time(1930, 2010).strftime('%Y-%m-%d'),
+            'address': [{'line': [f'{self.rng.randint(1, 999)} Main Street'], 'city': 'Boston', 'state': 'MA', 'country': 'US'}],
+            'maritalStatus': self.coding('http://terminology.hl7.org/CodeSystem/v3-MaritalStatus', 'M', 'Married'),
+            'multipleBirthBoolean': False,
+            'communication': [{'language': self.coding('urn:ietf:bcp:47', 'en-US', 'English')}]
+        }
+
+    def encounter(self, patient, practitioner, start):
+        code, display = self.rng.choice(encounter_types)
+        end = start + datetime.timedelta(minutes=self.rng.randint(15, 120))
+        return {
+            'resourceType': 'Encounter',
+            'id': self.uuid(),
+            'status': 'finished',
+            'class': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'AMB'},
+            'type': [self.coding(snomed_system, code, display)],
+            'subject': {'reference': f'urn:uuid:{patient["id"]}', 'display': patient['name'][0]['given'][0]},
+            'participant': [{
+                'type': [self.coding('http://terminology.hl7.org/CodeSystem/v3-ParticipationType', 'PPRF', 'primary performer')],
+                'period': {'start': self.fhir_date_time(start), 'end': self.fhir_date_time(end)},
+                'individual': self.practitioner_reference(practitioner)
+            }],
+            'period': {'start': self.fhir_date_time(start), 'end': self.fhir_date_time(end)},
+            'location': [{'location': self.location_reference(practitioner['organization'])}],
+            'serviceProvider': self.organization_reference(practitioner['organization'])
+        }
+
+    def observation(self, patient, encounter, effective):
+        common = {
+            'resourceType': 'Observation',
+            'id': self.uuid(),
+            'status': 'final',
+            'category': [self.coding('http://terminology.hl7.org/CodeSystem/observation-category', 'vital-signs', 'vital signs')],
+            'subject': {'reference': f'urn:uuid:{patient["id"]}'},
+            'encounter': {'reference': f'urn:uuid:{encounter["id"]}'},
+            'effectiveDateTime': self.fhir_date_time(effective),
+            'issued': effective.strftime('%Y-%m-%dT%H:%M:%S.123-05:00')
+        }
+        if self.rng.random() < 0.3:
+            common['code'] = self.coding(loinc_system, '85354-9', 'Blood pressure panel with all children optional')
+            common['component'] = [
+                {'code': self.coding(loinc_system, '8462-4', 'Diastolic Blood Pressure'),
+                 'valueQuantity': {'value': self.rng.randint(60, 95), 'unit': 'mm[Hg]', 'system': 'http://unitsofmeasure.org', 'code': 'mm[Hg]'}},
+                {'code': self.coding(loinc_system, '8480-6', 'Systolic Blood Pressure'),
+                 'valueQuantity': {'value': self.rng.randint(100, 150), 'unit': 'mm[Hg]', 'system': 'http://unitsofmeasure.org', 'code': 'mm[Hg]'}}
+            ]
+        else:
+            code, display, unit, low, high = self.rng.choice(vital_signs)
+            common['code'] = self.coding(loinc_system, code, display)
+            common['valueQuantity'] = {'value': round(self.rng.uniform(low, high), 1), 'unit': unit,
+                                       'system': 'http://unitsofmeasure.org', 'code': unit}
+        return common
+
+    def claim_items(self, encounter):
+        items = []
+        for i in range(self.config.claim_items):
+            code, display = self.rng.choice(procedures)
+            items.append({
+                'sequence': i + 1,
+                'productOrService': self.coding(snomed_system, code, display),
+                'encounter': [{'reference': f'urn:uuid:{encounter["id"]}'}],
+                'net': {'value': round(self.rng.uniform(10, 2000), 2), 'currency': 'USD'}
+            })
+        return items
+
+    def claim(self, patient, encounter, practitioner, created, payer):
+        items = self.claim_items(encounter)
+        return {
+            'resourceType': 'Claim',
+            'id': self.uuid(),
+            'status': 'active',
+            'type': self.coding('http://terminology.hl7.org/CodeSystem/claim-type', 'professional', 'professional'),
+            'use': 'claim',
+            'patient': {'reference': f'urn:uuid:{patient["id"]}'},
+            'billablePeriod': encounter['period'],
+            'created': self.fhir_date_time(created),
+            'provider': self.organization_reference(practitioner['organization']),
+            'priority': self.coding('http://terminology.hl7.org/CodeSystem/processpriority', 'normal', 'normal'),
+            'insurance': [{'sequence': 1, 'focal': True, 'coverage': {'display': payer}}],
+            'item': items,
+            'total': {'value': round(sum(item['net']['value'] for item in items), 2), 'currency': 'USD'}
+        }
+
+    def explanation_of_benefit(self, patient, encounter, claim, practitioner, created, payer):
+        items = []
+        for claim_item in claim['item']:
+            adjudication = [
+                {'category': self.coding('https://bluebutton.cms.gov/resources/codesystem/adjudication', category, display),
+                 'amount': {'value': round(claim_item['net']['value'] * share, 2), 'currency': 'USD'}}
+                for category, display, share in [('https://bluebutton.cms.gov/resources/variables/line_coinsrnc_amt', 'Line Beneficiary Coinsurance Amount', 0.2),
+                                                 ('https://bluebutton.cms.gov/resources/variables/line_prvdr_pmt_amt', 'Line Provider Payment Amount', 0.8),
+                                                 ('https://bluebutton.cms.gov/resources/variables/line_sbmtd_chrg_amt', 'Line Submitted Charge Amount', 1.0)]
+            ]
+            items.append({
+                'sequence': claim_item['sequence'],
+                'category': self.coding('https://bluebutton.cms.gov/resources/variables/line_cms_type_srvc_cd', '1', 'Medical care'),
+                'productOrService': claim_item['productOrService'],
+                'servicedPeriod': encounter['period'],
+                'locationCodeableConcept': self.coding('http://terminology.hl7.org/CodeSystem/ex-serviceplace', '19', 'Off Campus-Outpatient Hospital'),
+                'encounter': claim_item['encounter'],
+                'adjudication': adjudication
+            })
+        coverage_id = self.uuid()
+        return {
+            'resourceType': 'ExplanationOfBenefit',
+            'id': self.uuid(),
+            'contained': [
+                {'resourceType': 'ServiceRequest', 'id': 'referral', 'status': 'completed', 'intent': 'order',
+                 'subject': {'reference': f'urn:uuid:{patient["id"]}'},
+                 'requester': self.practitioner_reference(practitioner),
+                 'performer': [self.practitioner_reference(practitioner)]},
+                {'resourceType': 'Coverage', 'id': coverage_id, 'status': 'active', 'type': {'text': payer},
+                 'beneficiary': {'reference': f'urn:uuid:{patient["id"]}'}, 'payor': [{'display': payer}]}
+            ],
+            'identifier': [{'system': 'https://bluebutton.cms.gov/resources/variables/clm_id', 'value': claim['id']}],
+            'status': 'active',
+            'type': self.coding('http://terminology.hl7.org/CodeSystem/claim-type', 'professional', 'professional'),
+            'use': 'claim',
+            'patient': {'reference': f'urn:uuid:{patient["id"]}'},
+            'billablePeriod': encounter['period'],
+            'created': self.fhir_date_time(created),
+            'insurer': {'display': payer},
+            'provider': self.practitioner_reference(practitioner),
+            'referral': {'reference': '#referral'},
+            'claim': {'reference': f'urn:uuid:{claim["id"]}'},
+            'outcome': 'complete',
+            'careTeam': [{'sequence': 1, 'provider': self.practitioner_reference(practitioner),
+                          'role': self.coding('http://terminology.hl7.org/CodeSystem/claimcareteamrole', 'primary', 'Primary provider')}],
+            'insurance': [{'focal': True, 'coverage': {'reference': f'#{coverage_id}', 'display': payer}}],
+            'item': items,
+            'total': [{'category': self.coding('http://terminology.hl7.org/CodeSystem/adjudication', 'submitted', 'Submitted Amount'),
+                       'amount': claim['total']}],
+            'payment': {'amount': {'value': round(claim['total']['value'] * 0.8, 2), 'currency': 'USD'}}
+        }
+
+    def document_reference(self, patient, encounter, practitioner, date):
+        note = ('Patient seen for ' + encounter['type'][0]['text'] + '. ') * max(1, self.config.document_size // 48)
+        data = base64.b64encode(note.encode('utf-8')[:self.config.document_size]).decode('ascii')
+        return {
+            'resourceType': 'DocumentReference',
+            'id': self.uuid(),
+            'status': 'superseded',
+            'type': [self.coding(loinc_system, '34117-2', 'History and physical note')],
+            'subject': {'reference': f'urn:uuid:{patient["id"]}'},
+            'date': date.strftime('%Y-%m-%dT%H:%M:%S.000-05:00'),
+            'author': [self.practitioner_reference(practitioner)],
+            'custodian': self.organization_reference(practitioner['organization']),
+            'content': [{'attachment': {'contentType': 'text/plain; charset=utf-8', 'data': data}}],
+            'context': {'encounter': [{'reference': f'urn:uuid:{encounter["id"]}'}], 'period': encounter['period']}
+        }
+
+    def provenance(self, patient, resources, recorded):
+        return {
+            'resourceType': 'Provenance',
+            'id': self.uuid(),
+            'target': [{'reference': f'urn:uuid:{resource["id"]}'} for resource in resources],
+            'recorded': recorded.strftime('%Y-%m-%dT%H:%M:%S.000-05:00'),
+            'agent': [{'who': self.organization_reference(self.organizations[0])}]
+        }
+
+    def patient_bundle(self):
+        patient = self.patient()
+        payer = self.rng.choice(payers)
+        resources = [patient]
+        start = self.date_time(2000, 2023)
+        for i in range(self.config.encounters_per_patient):
+            practitioner = self.rng.choice(self.practitioners)
+            start = start + datetime.timedelta(days=self.rng.randint(20, 400), minutes=self.rng.randint(0, 600))
+            encounter = self.encounter(patient, practitioner, start)
+            resources.append(encounter)
+            for j in range(self.config.observations_per_encounter):
+                resources.append(self.observation(patient, encounter, start + datetime.timedelta(minutes=j)))
+            end = start + datetime.timedelta(hours=1)
+            claim = self.claim(patient, encounter, practitioner, end, payer)
+            resources.append(claim)
+            resources.append(self.explanation_of_benefit(patient, encounter, claim, practitioner, end, payer))
+            if self.config.document_size > 0:
+                resources.append(self.document_reference(patient, encounter, practitioner, start))
+        resources.append(self.provenance(patient, resources, start))
+        return patient, bundle(resources)
+
+    def hospital_bundle(self):
+        resources = []
+        for organization in self.organizations:
+            resources.append({
+                'resourceType': 'Organization',
+                'id': organization['id'],
+                'identifier': [{'system': synthea_system, 'value': organization['id']}],
+                'active': True,
+                'type': [self.coding('http://terminology.hl7.org/CodeSystem/organization-type', 'prov', 'Healthcare Provider')],
+                'name': organization['name'],
+                'address': [{'line': ['1 Hospital Drive'], 'city': 'Boston', 'state': 'MA', 'country': 'US'}]
+            })
+            resources.append({
+                'resourceType': 'Location',
+                'id': organization['location_id'],
+                'identifier': [{'system': synthea_system, 'value': organization['location_id']}],
+                'status': 'active',
+                'name': organization['name'],
+                'managingOrganization': self.organization_reference(organization)
+            })
+        return bundle(resources)
+
+    def practitioner_bundle(self):
+        resources = []
+        for practitioner in self.practitioners:
+            resources.append({
+                'resourceType': 'Practitioner',
+                'id': practitioner['id'],
+                'identifier': [{'system': npi_system, 'value': practitioner['npi']}],
+                'active': True,
+                'name': [{'family': practitioner['family'], 'given': [practitioner['given']], 'prefix': ['Dr.']}],
+                'gender': self.rng.choice(['male', 'female'])
+            })
+            resources.append({
+                'resourceType': 'PractitionerRole',
+                'id': self.uuid(),
+                'practitioner': {'identifier': {'system': npi_system, 'value': practitioner['npi']},
+                                 'display': f'Dr. {practitioner["given"]} {practitioner["family"]}'},
+                'organization': {'identifier': {'system': synthea_system, 'value': practitioner['organization']['id']},
+                                 'display': practitioner['organization']['name']},
+                'code': [self.coding('http://nucc.org/provider-taxonomy', '208D00000X', 'General Practice')],
+                'specialty': [self.coding('http://nucc.org/provider-taxonomy', '208D00000X', 'General Practice')]
+            })
+        return bundle(resources)
+
+
+def bundle(resources):
+    return {
+        'resourceType': 'Bundle',
+        'type': 'transaction',
+        'entry': [{'fullUrl': f'urn:uuid:{resource["id"]}', 'resource': resource} for resource in resources]
+    }
+
+
+# Yields (file name, bundle) for the patient bundles, then the hospital and practitioner bundles
+def synthetic_bundles(config):
+    population = SyntheticPopulation(config)
+    for i in range(config.patients):
+        patient, patient_bundle = population.patient_bundle()
+        name = patient['name'][0]
+        yield f'{name["given"][0]}_{name["family"]}_{patient["id"]}.json', patient_bundle
+    yield f'hospitalInformation{config.seed}.json', population.hospital_bundle()
+    yield f'practitionerInformation{config.seed}.json', population.practitioner_bundle()
+
+
+# Writes the bundles to bundle_dir, the same way Synthea lays them out, and returns the file names
+def write_synthetic_bundles(bundle_dir, config):
+    os.makedirs(bundle_dir, exist_ok=True)
+    file_names = []
+    for file_name, synthetic_bundle in synthetic_bundles(config):
+        file_name = os.path.join(bundle_dir, file_name)
+        with open(file_name, 'w') as out_file:
+            json.dump(synthetic_bundle, out_file)
+        file_names.append(file_name)
+    return file_names
@@ -1,4 +1,9 @@
+import datetime
+import hashlib
+import json
 import re
+from FHIR_flattener import KeyStyle, flatten
+from FHIR_metrics import metrics, flatten_stage, cypher_generation_stage
 from FHIR_to_string import FHIR_to_string
 
 camel_pattern1 = re.compile(r'(.)([A-Z][a-z]+)')
@@ -9,24 +14,13 @@ def split_camel(text):
     new_text = camel_pattern2.sub(r'\1_\2', new_text.strip())
     return new_text.lower().strip()
 
-def flatten_fhir(nested_json):
-    out = {}
+graph_key_style = KeyStyle('_', split_camel, skip=['text_'])
 
-    def flatten(json_to_flatten, name=''):
-        if name == 'text_':
-            return
-        elif type(json_to_flatten) is dict:
-            for sub_attribute in json_to_flatten:
-                flatten(json_to_flatten[sub_attribute], name + split_camel(sub_attribute) + '_')
-        elif type(json_to_flatten) is list:
-            for i, sub_json in enumerate(json_to_flatten):
-                flatten(sub_json, name + str(i) + '_')
-        else:
-            attrib_name = name[:-1]
-            out[attrib_name] = json_to_flatten
-
-    flatten(nested_json)
-    return out
+def flatten_fhir(nested_json):
+    if metrics.enabled:
+        with metrics.stage(flatten_stage):
+            return flatten(nested_json, graph_key_style)
+    return flatten(nested_json, graph_key_style)
 
 def flat_fhir_to_json_str(flat_fhir, name, fhir_str):
     output = '{' + f'name: "{name}",'
@@ -44,30 +38,85 @@ def flat_fhir_to_json_str(flat_fhir, name, fhir_str):
 
     return output
 
+# Same content as flat_fhir_to_json_str, but as a dict that can be sent as a query parameter
+def flat_fhir_to_properties(flat_fhir, name, fhir_str):
+    properties = {'name': name}
+
+    if fhir_str is not None:
+        properties['text'] = ' '.join(fhir_str)
+
+    for attrib in flat_fhir:
+        properties[attrib] = str(flat_fhir[attrib])
+
+    return properties
+
+# Labels used to scope the MATCH of each end of an edge, so the indexes created by Graph.ensure_schema() are used
+resource_label = 'resource'
+date_label = 'Date'
+practitioner_label = 'Practitioner'
+
+def id_to_key(id):
+    return {'id': id}
+
+def npi_to_key(id):
+    return {'identifier_0_value': id, 'identifier_0_system': 'http://hl7.org/fhir/sid/us-npi'}
+
+def key_to_property_str(key):
+    return '{' + ', '.join(f"{attrib}: '{key[attrib]}'" for attrib in key) + '}'
+
 def id_to_property_str(id):
-    return "{id: '" + id + "'}"
+    return key_to_property_str(id_to_key(id))
 
 def npi_to_property_str(id):
-    return "{identifier_0_value: '" + id + "', identifier_0_system: 'http://hl7.org/fhir/sid/us-npi'}"
+    return key_to_property_str(npi_to_key(id))
 
-def extract_id(value: str):
+# Returns the label and key of the node a reference points to
+def extract_key(value: str):
     if value.startswith('urn:uuid:'):
-        return id_to_property_str(value[9:])
+        return resource_label, id_to_key(value[9:])
     elif value.startswith('Location'):
         index = value.index('|')
-        return id_to_property_str(value[index+1:])
+        return resource_label, id_to_key(value[index+1:])
     elif value.startswith('Organization'):
         index = value.index('|')
-        return id_to_property_str(value[index+1:])
+        return resource_label, id_to_key(value[index+1:])
     elif value.startswith('Practitioner'):
         index = value.index('|')
-        return npi_to_property_str(value[index+1:])
+        return practitioner_label, npi_to_key(value[index+1:])
     elif value[0:1] == '#':
         return None
     else:
         print(f'Unrecognized reference: {value}')
         return None
 
+literal_reference_pattern = re.compile(r'(?:^|/)[A-Za-z]+/([A-Za-z0-9\-.]{1,64})(?:/_history/[^/]*)?$')
+
+# Returns the target of a reference, for FHIR_references.ReferenceResolver: ('id', id) for a literal reference
+# (urn:uuid:<id>, <type>/<id> or its url), ('identifier', system, value) for a logical one
+# (<type>?identifier=<system>|<value>), ('contained', reference) for a contained resource and
+# ('unrecognized', reference) for anything else
+def reference_target(value: str):
+    if value.startswith('urn:uuid:'):
+        return 'id', value[9:]
+    elif value[0:1] == '#':
+        return 'contained', value
+    elif '?identifier=' in value:
+        system, separator, identifier = value[value.index('?identifier=') + 12:].rpartition('|')
+        return 'identifier', system, identifier
+    match = literal_reference_pattern.search(value)
+    if match is not None:
+        return 'id', match[1]
+    return 'unrecognized', value
+
+def identifier_target(identifier):
+    return 'identifier', identifier.get('system', ''), str(identifier.get('value'))
+
+def extract_id(value: str):
+    label_and_key = extract_key(value)
+    if label_and_key is None:
+        return None
+    return key_to_property_str(label_and_key[1])
+
 date_containing_fields=[
     'effectiveDateTime', 'recordedDate', 'issued',
     'start', 'end', 'authoredOn', 'onsetDateTime',
@@ -78,12 +127,87 @@ def extract_date(value: str):
     data_parts = date_pattern.findall(value)[0]
     return f'{data_parts[1]}/{data_parts[2]}/{data_parts[0]}'
 
-def resource_to_edges(resource):
+# The key of the Date node of a native date, the same as extract_date of the field it came from
+def native_date_to_str(date):
+    return f'{date.month:02d}/{date.day:02d}/{date.year:04d}'
+
+# The date (ignoring time) of a date field, as a native date that is stored as a Neo4j DATE
+def extract_native_date(value: str):
+    data_parts = date_pattern.findall(value)[0]
+    return datetime.date(int(data_parts[0]), int(data_parts[1]), int(data_parts[2]))
+
+# The dates found in the date fields of a resource, sorted and without duplicates
+def resource_dates(resource):
+    dates = set()
+    def search(json_to_search, top=False):
+        if type(json_to_search) is dict:
+            for sub_attribute in json_to_search:
+                if top and sub_attribute == 'text':
+                    continue
+                elif sub_attribute in date_containing_fields:
+                    dates.add(extract_native_date(json_to_search[sub_attribute]))
+                elif sub_attribute != 'reference':
+                    search(json_to_search[sub_attribute])
+        elif type(json_to_search) is list:
+            for sub_json in json_to_search:
+                search(sub_json)
+
+    search(resource, top=True)
+    return sorted(dates)
+
+# Native date properties of a resource node: every date in it, and the first and last one, which have range
+# indexes (see Graph.ensure_schema) so date filters are index seeks
+def dates_to_properties(dates):
+    if len(dates) == 0:
+        return {}
+    return {'dates': dates, 'date_min': dates[0], 'date_max': dates[-1]}
+
+def dates_to_json_str(dates):
+    if len(dates) == 0:
+        return ''
+    date_strs = ', '.join(f"date('{date.isoformat()}')" for date in dates)
+    return f"dates: [{date_strs}], date_min: date('{dates[0].isoformat()}'), date_max: date('{dates[-1].isoformat()}')"
+
+def edge_to_cypher(resource_id, relation, label, key, date=None):
+    date_str = '' if date is None else f" {{date: date('{date.isoformat()}')}}"
+    return f'''
+        MATCH (n1:{resource_label} {id_to_property_str(resource_id)}), (n2:{label} {key_to_property_str(key)})
+        CREATE (n1)-[:{relation}{date_str}]->(n2)
+    '''
+
+# Without a label, key is the target of a reference (see reference_target) that is still to be resolved
+def edge_to_record(resource_id, relation, label, key, date=None):
+    if label is None:
+        record = {'type': relation, 'start_label': resource_label, 'start': id_to_key(resource_id), 'target': key}
+    else:
+        record = {'type': relation, 'start_label': resource_label, 'start': id_to_key(resource_id), 'end_label': label, 'end': key}
+    if date is not None:
+        record['properties'] = {'date': date}
+    return record
+
+# With as_records=True the edges are returned as dicts (relationship type and the keys of both ends)
+# that can be passed to Graph.create_edges, instead of one Cypher statement per edge.
+# Every edge has a native date: the date of the date field for edges to Date nodes, otherwise the first date
+# of the resource. With date_nodes=False no edges to Date nodes are returned, the dates are only kept as
+# properties (see resource_to_node).
+# With targets=True the references are not turned into keys, the records of their edges have the target of the
+# reference instead of an end, for a FHIR_references.ReferenceResolver to resolve. The edges to Date nodes are
+# returned as they are. An edge without an end can't be a Cypher statement, so targets=True needs as_records=True.
+def resource_to_edges(resource, as_records=False, date_nodes=True, targets=False):
+    if targets and not as_records:
+        raise Exception('targets=True needs as_records=True, the edges to targets have no end to MATCH')
+    if metrics.enabled:
+        with metrics.stage(cypher_generation_stage):
+            return search_edges(resource, as_records, date_nodes, targets)
+    return search_edges(resource, as_records, date_nodes, targets)
+
+def search_edges(resource, as_records, date_nodes=True, targets=False):
     resource_type = resource['resourceType']
     resource_id = resource['id']
 
     references = []
     dates = []
+    native_dates = []
     def search(json_to_flatten, name=''):
         if name == 'text_':
             return
@@ -91,54 +215,86 @@ def resource_to_edges(resource):
             for sub_attribute in json_to_flatten:
                 if sub_attribute == 'reference':
                     relation = name[:-1]
-                    reference_id_str = extract_id(json_to_flatten[sub_attribute])
-                    if reference_id_str is not None:
-                        cypher = f'''
-                            MATCH (n1 {id_to_property_str(resource_id)}), (n2 {reference_id_str})
-                            CREATE (n1)-[:{relation}]->(n2)
-                        '''
-                        references.append(cypher)
+                    if targets:
+                        references.append((relation, None, reference_target(json_to_flatten[sub_attribute]), None))
+                        continue
+                    reference = extract_key(json_to_flatten[sub_attribute])
+                    if reference is not None:
+                        references.append((relation, reference[0], reference[1], None))
                 elif resource_type == 'PractitionerRole' and sub_attribute == 'practitioner':
                     relation = 'practitioner'
-                    reference_id_str = npi_to_property_str(json_to_flatten[sub_attribute]['identifier']['value'])
-                    if reference_id_str is not None:
-                        cypher = f'''
-                            MATCH (n1 {id_to_property_str(resource_id)}), (n2 {reference_id_str})
-                            CREATE (n1)-[:{relation}]->(n2)
-                        '''
-                        references.append(cypher)
+                    if targets:
+                        references.append((relation, None, identifier_target(json_to_flatten[sub_attribute]['identifier']), None))
+                        continue
+                    reference_key = npi_to_key(json_to_flatten[sub_attribute]['identifier']['value'])
+                    references.append((relation, practitioner_label, reference_key, None))
                 elif resource_type == 'PractitionerRole' and sub_attribute == 'organization':
                     relation = 'organization'
-                    reference_id_str = id_to_property_str(json_to_flatten[sub_attribute]['identifier']['value'])
-                    if reference_id_str is not None:
-                        cypher = f'''
-                            MATCH (n1 {id_to_property_str(resource_id)}), (n2 {reference_id_str})
-                            CREATE (n1)-[:{relation}]->(n2)
-                        '''
-                        references.append(cypher)
+                    if targets:
+                        references.append((relation, None, identifier_target(json_to_flatten[sub_attribute]['identifier']), None))
+                        continue
+                    reference_key = id_to_key(json_to_flatten[sub_attribute]['identifier']['value'])
+                    references.append((relation, resource_label, reference_key, None))
                 elif sub_attribute in date_containing_fields:
-                    relation = name + split_camel(sub_attribute)
+                    relation = name + graph_key_style.normalize(sub_attribute)
                     date_str = extract_date(json_to_flatten[sub_attribute])
                     if date_str is not None:
-                        dates.append(date_str)
-                        cypher = f'''
-                            MATCH (n1 {id_to_property_str(resource_id)}), (n2 {id_to_property_str(date_str)})
-                            CREATE (n1)-[:{relation}]->(n2)
-                        '''
-                        references.append(cypher)
+                        native_date = extract_native_date(json_to_flatten[sub_attribute])
+                        native_dates.append(native_date)
+                        if date_nodes:
+                            dates.append(date_str)
+                            references.append((relation, date_label, id_to_key(date_str), native_date))
                 else:
-                    search(json_to_flatten[sub_attribute], name + split_camel(sub_attribute) + '_')
+                    search(json_to_flatten[sub_attribute], name + graph_key_style.normalize(sub_attribute) + '_')
         elif type(json_to_flatten) is list:
             for i, sub_json in enumerate(json_to_flatten):
                 search(sub_json, name + str(i) + '_')
 
     search(resource)
-    return references, dates
+    first_date = min(native_dates) if len(native_dates) > 0 else None
+    references = [(relation, label, key, first_date if date is None else date) for relation, label, key, date in references]
+    if as_records:
+        return [edge_to_record(resource_id, *reference) for reference in references], dates
+    return [edge_to_cypher(resource_id, *reference) for reference in references], dates
+
+# With as_records=True the node is returned as a dict of labels and properties
+# that can be passed to Graph.create_nodes, instead of a CREATE statement.
+# With a projection (see FHIR_projection.Projection) the properties and dates are those of the projected resource, so
+# the fields it leaves out or moves to its blob store are never flattened or searched. The text is still that of
+# the whole resource.
+# With content_hash=True (and as_records=True) the content_hash property is set to the resource_hash of the
+# projected resource, whose blob references already stand for the values moved out of it.
+def resource_to_node(resource, as_records=False, projection=None, content_hash=False):
+    projected = projection.project(resource) if projection is not None else resource
+    flat_resource = flatten_fhir(projected)
+    fhir_str = FHIR_to_string(resource)
+    if metrics.enabled:
+        with metrics.stage(cypher_generation_stage):
+            return flat_resource_to_node(resource, projected, flat_resource, fhir_str, as_records, content_hash)
+    return flat_resource_to_node(resource, projected, flat_resource, fhir_str, as_records, content_hash)
 
-def resource_to_node(resource):
+def flat_resource_to_node(resource, projected, flat_resource, fhir_str, as_records, content_hash):
     resource_type = resource['resourceType']
-    flat_resource = flat_fhir_to_json_str(flatten_fhir(resource), resource_name(resource), FHIR_to_string(resource))
-    return f'CREATE (:{resource_type}:resource {flat_resource})'
+    dates = resource_dates(projected)
+    if as_records:
+        properties = flat_fhir_to_properties(flat_resource, resource_name(resource), fhir_str)
+        properties.update(dates_to_properties(dates))
+        if content_hash:
+            properties['content_hash'] = resource_hash(projected)
+        return {'labels': [resource_type, resource_label], 'properties': properties}
+    flat_resource = flat_fhir_to_json_str(flat_resource, resource_name(resource), fhir_str)
+    if len(dates) > 0:
+        flat_resource = flat_resource[:-1] + ',' + dates_to_json_str(dates) + '}'
+    return f'CREATE (:{resource_type}:{resource_label} {flat_resource})'
+
+# Hash of the content of a resource, stored on its node so unchanged resources can be skipped on reload
+def resource_hash(resource):
+    return hashlib.sha256(json.dumps(resource, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def date_to_node(date, as_records=False):
+    if as_records:
+        return {'labels': [date_label], 'properties': {'name': date, 'id': date}}
+    return f'CREATE (:{date_label} ' + '{name:"' + date + '", id: "' + date + '"})'
 
 
 def resource_name(resource):
@@ -1,5 +1,7 @@
 import re
-from FHIR_flattener import flatten_fhir, flat_to_string, find_patient
+from functools import lru_cache
+from FHIR_flattener import flatten_fhir, flat_to_string, find_patient, resource_metadata
+from FHIR_metrics import metrics, text_conversion_stage
 
 what_to_call_resource = 'entry'
 
@@ -7,6 +9,8 @@ camel_pattern1 = re.compile(r'(.)([A-Z][a-z]+)')
 camel_pattern2 = re.compile(r'([a-z0-9])([A-Z])')
 
 
+# Memoized, the same field names and labels are split over and over again
+@lru_cache(maxsize=8192)
 def split_camel(text):
     new_text = camel_pattern1.sub(r'\1 \2', text.strip())
     new_text = camel_pattern2.sub(r'\1 \2', new_text.strip())
@@ -362,6 +366,77 @@ class GenericConverter:
         return output
 
 
+# Plans of CompiledConverter, per field_to_str_dict: {id(dict): (dict, {parent_field: {field: plan}})}
+compiled_plans = {}
+
+plan_resource_type = 0
+plan_field = 1
+plan_nested = 2
+
+
+# Produces the same output as GenericConverter, but the first time a (parent field, field) is seen for a
+# field_to_str_dict it works out how to convert it and the label to pass down, and caches that as a plan.
+# Every resource with the same shape then runs from the cached plans, writing into a single output list.
+class CompiledConverter(GenericConverter):
+    def __init__(self, resource, doc=None, field_to_str_dict=None):
+        super().__init__(resource, doc, field_to_str_dict)
+        dict_plans = compiled_plans.get(id(self.field_to_str_dict))
+        if dict_plans is None or dict_plans[0] is not self.field_to_str_dict:
+            dict_plans = (self.field_to_str_dict, {})
+            compiled_plans[id(self.field_to_str_dict)] = dict_plans
+        self._plans = dict_plans[1]
+
+    def plan(self, field_plans, parent_field, field):
+        if field == 'resourceType':
+            plan = (plan_resource_type, None, None, None)
+        elif field in self.field_to_str_dict:
+            plan = (plan_field, self.field_to_str_dict[field], combine_fields(parent_field, field), None)
+        else:
+            # the labels for the items of a list are filled in as they are needed
+            plan = (plan_nested, None, combine_fields(parent_field, field), [])
+        field_plans[field] = plan
+        return plan
+
+    def convert(self, resource=None, parent_field='', converter=None):
+        if resource is None:
+            resource = self.resource
+        if converter is None:
+            converter = self
+        output = []
+        self.convert_into(resource, parent_field, converter, output)
+        return output
+
+    def convert_into(self, resource, parent_field, converter, output):
+        if type(resource) is dict:
+            field_plans = self._plans.get(parent_field)
+            if field_plans is None:
+                field_plans = self._plans[parent_field] = {}
+            for field, value in resource.items():
+                plan = field_plans.get(field)
+                if plan is None:
+                    plan = self.plan(field_plans, parent_field, field)
+                kind, to_str, label, item_labels = plan
+                if kind == plan_field:
+                    output += to_str(value, converter, parent_field=label)
+                elif kind == plan_resource_type:
+                    output += resource_type_to_str(value, converter)
+                    converter.doc = split_camel(value)
+                elif type(value) is dict:
+                    self.convert_into(value, label, converter, output)
+                elif type(value) is list:
+                    if len(value) == 1:
+                        self.convert_into(value[0], label, converter, output)
+                    else:
+                        for i, item in enumerate(value):
+                            if i == len(item_labels):
+                                item_labels.append(combine_fields(parent_field, combine_fields(field, i)))
+                            self.convert_into(item, item_labels[i], converter, output)
+                else:
+                    output += default_to_str(value, converter, parent_field=label)
+        else:
+            output += default_to_str(resource, converter, parent_field=parent_field)
+
+
 class IgnoreConverter(GenericConverter):
     def __init__(self, resource, doc=None, field_to_str_dict=None):
         super().__init__(resource, doc, field_to_str_dict)
@@ -379,6 +454,15 @@ resource_conveter_dict = {
 }
 
 
+compiled_resource_conveter_dict = {
+    'DocumentReference': lambda resource, doc=None: IgnoreConverter(resource, doc=doc),
+    'DiagnosticReport': lambda resource, doc=None: IgnoreConverter(resource, doc=doc),
+    'Claim': lambda resource, doc=None: CompiledConverter(resource, doc=doc, field_to_str_dict=claim_field_to_str_dict),
+    'ExplanationOfBenefit': lambda resource, doc=None: CompiledConverter(resource, doc=doc,
+                                                                         field_to_str_dict=explanation_of_benefit_field_to_str_dict)
+}
+
+
 def date_of_birth_to_str(date):
     data_time = date_time_pattern2.findall(date)[0]
     return f'{data_time[1]}/{data_time[2]}/{data_time[0]}'
@@ -388,20 +472,47 @@ def patient_to_str(patient, doc=what_to_call_resource):
     return f'This {doc} is for patient {patient["PatientFirstName"]} {patient["PatientLastName"]}. Who was born on {date_of_birth_to_str(patient["dateOfBirth"])} and whose gender is {patient["gender"]}.'
 
 
-def FHIR_to_string(resource):
+# With compiled=True the resource is converted with CompiledConverter, the output is the same. It is opt-in: it is no
+# faster than GenericConverter on the synthetic bundles (see FHIR_benchmark), so the pipelines use the generic one.
+def FHIR_to_string(resource, compiled=False):
+    if metrics.enabled:
+        with metrics.stage(text_conversion_stage):
+            return resource_to_string(resource, compiled)
+    return resource_to_string(resource, compiled)
+
+
+def resource_to_string(resource, compiled=False):
     resource_type = resource['resourceType']
+    if compiled:
+        if resource_type in compiled_resource_conveter_dict:
+            return compiled_resource_conveter_dict[resource_type](resource).convert()
+        return CompiledConverter(resource).convert()
     if resource_type in resource_conveter_dict:
         return resource_conveter_dict[resource_type](resource).convert()
     return GenericConverter(resource).convert()
 
 
-def FHIR_bundle_to_strings(bundle):
+# The patient header that FHIR_bundle_to_strings puts before the string of each resource
+def FHIR_bundle_header(bundle):
+    patient, patient_name = find_patient(bundle)
+    return patient_to_str(patient)
+
+
+# With with_metadata=True, also returns the resource id, patient id and resource type of each string.
+# With include_header=False the patient header is left out of the strings, so it can be stored once per patient
+# (see FHIR_bundle_header) instead of in every string.
+def FHIR_bundle_to_strings(bundle, compiled=False, with_metadata=False, include_header=True):
     patient, patient_name = find_patient(bundle)
     patient_str = patient_to_str(patient)
     output = []
+    metadata = []
     for entry in bundle['entry']:
-        fhir_str = FHIR_to_string(entry['resource'])
+        fhir_str = FHIR_to_string(entry['resource'], compiled=compiled)
         if fhir_str is not None:
             fhir_str = ' '.join(fhir_str)
-            output.append(f'{patient_str}\n{fhir_str}')
+            output.append(f'{patient_str}\n{fhir_str}' if include_header else fhir_str)
+            if with_metadata:
+                metadata.append(resource_metadata(entry['resource'], patient))
+    if with_metadata:
+        return output, patient_name, metadata
     return output, patient_name
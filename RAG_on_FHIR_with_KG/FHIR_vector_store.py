@@ -0,0 +1,219 @@
+import json
+import os
+
+import numpy as np
+
+from FHIR_corpus import with_header
+from FHIR_embeddings import embed_texts
+from FHIR_metrics import metrics, embedding_stage, retrieval_stage
+
+# A local vector store over the texts of the resources, for offline evaluation and small deployments that should
+# not depend on the Neo4j vector index.
+#
+# A store is a directory with:
+#   vectors.f32         the normalized float32 embeddings, one row per text
+#   resource_ids.npy    the resource id of each row
+#   patient_codes.npy   the patient of each row, as an index into patients in store.json
+#   type_codes.npy      the resource type of each row, as an index into resource_types in store.json
+#   texts.txt           the texts, utf-8, with text_offsets.npy giving where each one starts and ends
+#   store.json          the number of rows, the dimensions, the model name and the patients and resource types
+#   headers.json        the shared patient headers, for texts embedded without them (see FHIR_corpus), by patient id.
+#                       The texts of a patient with a header here are returned by search with the header in front.
+# Everything is opened memory-mapped, so opening a store doesn't read it, and only the rows that are scored are
+# ever paged in.
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+# Writes a store one batch of rows at a time, so the vectors of the whole corpus are never held in memory
+class VectorStoreWriter:
+    def __init__(self, directory, model_name):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._model_name = model_name
+        self._vectors = open(os.path.join(directory, 'vectors.f32'), 'wb')
+        self._texts = open(os.path.join(directory, 'texts.txt'), 'wb')
+        self.dimensions = None
+        self.count = 0
+        self._resource_ids = []
+        self._patient_codes = []
+        self._type_codes = []
+        self._text_offsets = [0]
+        self._patients = {}
+        self._resource_types = {}
+        self._headers = {}
+
+    def add(self, vectors, texts, metadata):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        elif vectors.shape[1] != self.dimensions:
+            raise Exception(f'Expected vectors of {self.dimensions} dimensions, got {vectors.shape[1]}')
+        normalize_rows(vectors).astype(np.float32).tofile(self._vectors)
+
+        for text, meta in zip(texts, metadata):
+            data = text.encode('utf-8')
+            self._texts.write(data)
+            self._text_offsets.append(self._text_offsets[-1] + len(data))
+            self._resource_ids.append(meta['resource_id'])
+            self._patient_codes.append(self._patients.setdefault(meta['patient_id'], len(self._patients)))
+            self._type_codes.append(self._resource_types.setdefault(meta['resource_type'], len(self._resource_types)))
+        self.count += len(vectors)
+
+    def add_header(self, patient_id, header):
+        self._headers[patient_id] = header
+
+    def close(self):
+        self._vectors.close()
+        self._texts.close()
+        np.save(os.path.join(self._directory, 'resource_ids.npy'), np.array(self._resource_ids, dtype='S'))
+        np.save(os.path.join(self._directory, 'patient_codes.npy'), np.array(self._patient_codes, dtype=np.int32))
+        np.save(os.path.join(self._directory, 'type_codes.npy'), np.array(self._type_codes, dtype=np.int16))
+        np.save(os.path.join(self._directory, 'text_offsets.npy'), np.array(self._text_offsets, dtype=np.int64))
+        with open(os.path.join(self._directory, 'store.json'), 'w') as store_file:
+            json.dump({
+                'count': self.count,
+                'dimensions': self.dimensions if self.dimensions is not None else 0,
+                'model_name': self._model_name,
+                'patients': list(self._patients),
+                'resource_types': list(self._resource_types)
+            }, store_file)
+        with open(os.path.join(self._directory, 'headers.json'), 'w', encoding='utf-8') as headers_file:
+            json.dump(self._headers, headers_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Embeds the (text, metadata) documents (e.g. from FHIR_corpus.bundle_documents, or a CorpusReader) batch_size at
+# a time and writes them to a store in directory.
+# With an EmbeddingCache, texts that were embedded before are not embedded again. Returns the number of rows.
+# For documents without their patient header (e.g. CorpusReader(path, attach_headers=False) of a corpus written with
+# shared_header=True) headers is {patient id: header}, e.g. CorpusReader.headers().
+def build_vector_store(directory, documents, embedder, model_name, cache=None, batch_size=64, headers=None):
+    with VectorStoreWriter(directory, model_name) as writer:
+        for patient_id, header in (headers or {}).items():
+            writer.add_header(patient_id, header)
+        texts = []
+        metadata = []
+        for text, meta in documents:
+            texts.append(text)
+            metadata.append(meta)
+            if len(texts) >= batch_size:
+                writer.add(embed_batch(texts, embedder, cache, model_name, batch_size), texts, metadata)
+                texts = []
+                metadata = []
+        if len(texts) > 0:
+            writer.add(embed_batch(texts, embedder, cache, model_name, batch_size), texts, metadata)
+        return writer.count
+
+
+def embed_batch(texts, embedder, cache, model_name, batch_size):
+    if cache is not None:
+        return embed_texts(texts, embedder, cache, model_name, batch_size)
+    with metrics.stage(embedding_stage, len(texts)):
+        return embedder.embed_documents(texts)
+
+
+class LocalVectorStore:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'store.json')) as store_file:
+            store = json.load(store_file)
+        self.count = store['count']
+        self.dimensions = store['dimensions']
+        self.model_name = store['model_name']
+        self.patients = store['patients']
+        self.resource_types = store['resource_types']
+        self._patient_codes_by_id = {patient: code for code, patient in enumerate(self.patients)}
+        self._type_codes_by_name = {resource_type: code for code, resource_type in enumerate(self.resource_types)}
+        headers_file_name = os.path.join(directory, 'headers.json')
+        self.headers = {}
+        if os.path.exists(headers_file_name):
+            with open(headers_file_name, encoding='utf-8') as headers_file:
+                self.headers = json.load(headers_file)
+
+        if self.count > 0:
+            self.vectors = np.memmap(os.path.join(directory, 'vectors.f32'), dtype=np.float32, mode='r',
+                                     shape=(self.count, self.dimensions))
+            self._texts = np.memmap(os.path.join(directory, 'texts.txt'), dtype=np.uint8, mode='r')
+        else:
+            self.vectors = np.zeros((0, self.dimensions), dtype=np.float32)
+            self._texts = np.zeros(0, dtype=np.uint8)
+        self.resource_ids = np.load(os.path.join(directory, 'resource_ids.npy'), mmap_mode='r')
+        self.patient_codes = np.load(os.path.join(directory, 'patient_codes.npy'), mmap_mode='r')
+        self.type_codes = np.load(os.path.join(directory, 'type_codes.npy'), mmap_mode='r')
+        self._text_offsets = np.load(os.path.join(directory, 'text_offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.count
+
+    def text(self, row):
+        return bytes(self._texts[self._text_offsets[row]:self._text_offsets[row + 1]]).decode('utf-8')
+
+    # The rows that pass the filters, or None when there are no filters. An unknown patient or resource type
+    # matches nothing.
+    def candidates(self, patient_id=None, resource_types=None):
+        mask = None
+        if patient_id is not None:
+            code = self._patient_codes_by_id.get(patient_id, -1)
+            mask = self.patient_codes == code
+        if resource_types is not None:
+            allowed = np.zeros(len(self.resource_types) + 1, dtype=bool)
+            for resource_type in resource_types:
+                if resource_type in self._type_codes_by_name:
+                    allowed[self._type_codes_by_name[resource_type]] = True
+            type_mask = allowed[self.type_codes]
+            mask = type_mask if mask is None else mask & type_mask
+        if mask is None:
+            return None
+        return np.flatnonzero(mask)
+
+    # The text of a row with the header of its patient, if it was stored without it
+    def text_with_header(self, row):
+        text = self.text(row)
+        header = self.headers.get(self.patients[self.patient_codes[row]])
+        return text if header is None else with_header(header, text)
+
+    # The k rows most similar (by cosine) to query_vector, best first, as dicts of score, resource id, patient id,
+    # resource type and text. The filters are applied before scoring, so only the matching rows are read.
+    # With with_header=False the texts stored without their patient header are returned without it.
+    def search(self, query_vector, k=5, patient_id=None, resource_types=None, with_header=True):
+        with metrics.stage(retrieval_stage):
+            query_vector = np.asarray(query_vector, dtype=np.float32)
+            norm = np.linalg.norm(query_vector)
+            if norm > 0:
+                query_vector = query_vector / norm
+
+            rows = self.candidates(patient_id, resource_types)
+            if rows is None:
+                scores = self.vectors @ query_vector
+            else:
+                scores = self.vectors[rows] @ query_vector
+
+            k = min(k, len(scores))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            if rows is not None:
+                top_rows = rows[top]
+            else:
+                top_rows = top
+
+            return [{
+                'score': float(score),
+                'resource_id': self.resource_ids[row].decode('ascii'),
+                'patient_id': self.patients[self.patient_codes[row]],
+                'resource_type': self.resource_types[self.type_codes[row]],
+                'text': self.text_with_header(row) if with_header else self.text(row)
+            } for row, score in zip(top_rows, scores[top])]
+
+    def search_text(self, query, embedder, k=5, patient_id=None, resource_types=None, with_header=True):
+        return self.search(embedder.embed_query(query), k, patient_id, resource_types, with_header)
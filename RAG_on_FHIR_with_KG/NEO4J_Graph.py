@@ -1,71 +1,420 @@
 import time
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, AsyncGraphDatabase
+from FHIR_metrics import metrics, db_write_stage
 
 
+# Runtime in seconds, from a monotonic clock
 class timer:
     def __init__(self):
-        self._start = time.time()
+        self._start = time.perf_counter()
         self._end = None
         self._runtime = None
 
     def end(self):
-        self._end = time.time()
-        self._runtime = float(str(time.time() - self._start)[:5])
+        self._end = time.perf_counter()
+        self._runtime = self._end - self._start
         return self._runtime
 
 
+# Cypher for a batch of node records (see FHIR_to_graph.resource_to_node) that share the same labels
+def node_batch_cypher(labels):
+    label_str = ''.join(f':`{label}`' for label in labels)
+    return f'''
+        UNWIND $rows AS row
+        CREATE (n{label_str})
+        SET n = row
+    '''
+
+
+# Cypher for a batch of node records that share the same labels, merged on the id of the last label
+# (resource or Date) and with their properties replaced by the ones in the record
+def node_merge_batch_cypher(labels):
+    label_str = ''.join(f'\n        SET n:`{label}`' for label in labels[:-1])
+    return f'''
+        UNWIND $rows AS row
+        MERGE (n:`{labels[-1]}` {{id: row.id}})
+        SET n = row{label_str}
+    '''
+
+
+def key_to_row_pattern(key, name):
+    return '{' + ', '.join(f'{attrib}: row.{name}.{attrib}' for attrib in key) + '}'
+
+
+# Cypher for a batch of edge records (see FHIR_to_graph.resource_to_edges) that share the same
+# relationship type and the same labels and shape of keys on each end. With properties=True the properties
+# of the relationships (e.g. its date) are set from the rows. With merge=True an edge that is already there is
+# updated instead of created again, so the same records can be written twice.
+def edge_batch_cypher(relation, start_label, start_key, end_label, end_key, properties=False, merge=False):
+    set_str = '\n        SET r = row.properties' if properties else ''
+    write_str = 'MERGE' if merge else 'CREATE'
+    return f'''
+        UNWIND $rows AS row
+        MATCH (n1:`{start_label}` {key_to_row_pattern(start_key, 'start')}), (n2:`{end_label}` {key_to_row_pattern(end_key, 'end')})
+        {write_str} (n1)-[r:`{relation}`]->(n2){set_str}
+    '''
+
+
+def node_record_batch(record):
+    return node_batch_cypher(record['labels']), record['properties']
+
+
+def node_record_merge_batch(record):
+    return node_merge_batch_cypher(record['labels']), record['properties']
+
+
+def edge_record_batch(record, merge=False):
+    properties = record.get('properties')
+    cypher = edge_batch_cypher(record['type'], record['start_label'], record['start'], record['end_label'], record['end'],
+                               properties is not None, merge)
+    if properties is not None:
+        return cypher, {'start': record['start'], 'end': record['end'], 'properties': properties}
+    return cypher, {'start': record['start'], 'end': record['end']}
+
+
+def edge_record_merge_batch(record):
+    return edge_record_batch(record, merge=True)
+
+
+# Number of items a statement writes, for the metrics: the number of rows of an UNWIND batch, otherwise 1
+def statement_items(parameters):
+    if parameters is not None and 'rows' in parameters:
+        return len(parameters['rows'])
+    return 1
+
+
+# Constraints and indexes backing the keys used to MATCH the ends of edges (and the Chunk nodes, see FHIR_chunking),
+# and the range indexes on the
+# native dates of the resources used to pre-filter retrieval by date (see FHIR_retrieval)
+schema_cypher = [
+    'CREATE CONSTRAINT resource_id IF NOT EXISTS FOR (n:resource) REQUIRE n.id IS UNIQUE',
+    'CREATE CONSTRAINT date_id IF NOT EXISTS FOR (n:Date) REQUIRE n.id IS UNIQUE',
+    'CREATE CONSTRAINT chunk_id IF NOT EXISTS FOR (n:Chunk) REQUIRE n.id IS UNIQUE',
+    'CREATE INDEX practitioner_npi IF NOT EXISTS FOR (n:Practitioner) ON (n.identifier_0_value, n.identifier_0_system)',
+    'CREATE RANGE INDEX resource_date_min IF NOT EXISTS FOR (n:resource) ON (n.date_min)',
+    'CREATE RANGE INDEX resource_date_max IF NOT EXISTS FOR (n:resource) ON (n.date_max)',
+]
+
+# Cypher that sets the neighbor_context of each node: the text of at most $max_neighbors of the resources next to
+# it, as secondary entries of at most $max_length characters in total, counting the separator in front of each.
+# Resources the node references come first, then the ones referencing it, each by how close their first date is to
+# the node's, so hub nodes (e.g. a Patient or an Organization) get a bounded context of their closest neighbors.
+neighbor_context_cypher = '''
+        CALL {
+            WITH node
+            OPTIONAL MATCH (node)-[r]-(sc:resource)
+            WITH node, r, sc
+            ORDER BY CASE WHEN startNode(r) = node THEN 0 ELSE 1 END,
+                     abs(duration.inDays(node.date_min, sc.date_min).days),
+                     sc.id
+            WITH collect(DISTINCT sc.text)[..$max_neighbors] AS secondary, '\\n\\nSecondary Entry:\\n' AS separator
+            RETURN reduce(s = '', item IN secondary |
+                CASE WHEN size(s) + size(separator) + size(item) > $max_length THEN s ELSE s + separator + item END
+            ) AS context
+        }
+        SET node.neighbor_context = context
+'''
+
+# Cypher that sets the neighbor_context of the $limit resource nodes after the id $after, and returns the last id
+neighbor_context_page_cypher = '''
+        MATCH (node:resource)
+        WHERE node.id > $after
+        WITH node ORDER BY node.id LIMIT $limit
+''' + neighbor_context_cypher + '''
+        RETURN max(node.id), count(node)
+'''
+
+# Labels that are not the type of a FHIR resource
+non_resource_labels = ['resource', 'Date', 'Chunk']
+
+
 class Graph:
-    def __init__(self, url, username, password):
+    # The driver is created once and keeps a pool of connections that is reused by every query.
+    # Call close() when done, or use the Graph as a context manager.
+    # An already created driver can be passed in instead, e.g. the in-process one FHIR_benchmark uses.
+    def __init__(self, url, username, password, max_connection_pool_size=100, max_transaction_retry_time=30.0,
+                 driver=None):
         self._url = url
         self._username = username
         self._password = password
+        if driver is None:
+            driver = GraphDatabase.driver(url, auth=(username, password),
+                                          max_connection_pool_size=max_connection_pool_size,
+                                          max_transaction_retry_time=max_transaction_retry_time)
+        self._driver = driver
+
+    def close(self):
+        self._driver.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     # Helper function that runs cypher transaction on local database
-    def cypher_transaction(self, cypher):
-        driver = GraphDatabase.driver(self._url, auth=(self._username, self._password))
+    def cypher_transaction(self, cypher, parameters=None):
         values = []
-        with driver.session() as session:
-            res = session.run(cypher)
+        with self._driver.session() as session:
+            res = session.run(cypher, parameters)
             for record in res:
                 values.append(record.values())
-        driver.close()
         return values
 
-    # Helper function wrapped around cypher_transaction() for timing
-    def query(self, cypher):
+    # Helper function wrapped around cypher_transaction() for timing. The runtime is recorded in the metrics under
+    # stage if one is given (e.g. db_write_stage for the statements that write), reads are timed by their callers.
+    def query(self, cypher, parameters=None, stage=None):
         time = timer()
-        result = self.cypher_transaction(cypher)
+        result = self.cypher_transaction(cypher, parameters)
         runtime = time.end()
+        if stage is not None and metrics.enabled:
+            metrics.record(stage, runtime, statement_items(parameters))
         return result, runtime
 
-    # Get type and number of each FHIR resource in the database
-    def resource_metrics(self):
+    # Runs all the statements in a single explicit write transaction. Each statement is either a cypher
+    # string or a (cypher, parameters) tuple. The transaction is retried by the driver on transient errors
+    # (deadlocks, leader changes, etc.) for up to max_transaction_retry_time seconds.
+    def write_transaction(self, statements):
+        def run_statements(tx):
+            results = []
+            for statement in statements:
+                if type(statement) is tuple:
+                    cypher, parameters = statement
+                else:
+                    cypher, parameters = statement, None
+                results.append([record.values() for record in tx.run(cypher, parameters)])
+            return results
+
+        time = timer()
+        with self._driver.session() as session:
+            results = session.execute_write(run_statements)
+        runtime = time.end()
+        if metrics.enabled:
+            items = sum(statement_items(statement[1]) if type(statement) is tuple else 1 for statement in statements)
+            metrics.record(db_write_stage, runtime, items)
+        return results, runtime
+
+    # Groups records by the statement they need and sends each group as UNWIND batches of batch_size rows.
+    # If window is set, all the pending groups are flushed once window records are held, so memory stays
+    # bounded however many statement shapes the records need. Returns the number of records written and
+    # the total runtime.
+    def write_batches(self, records, record_batch, batch_size=1000, window=None):
+        pending = {}
+        pending_count = 0
+        count = 0
+        runtime = 0
+        for record in records:
+            cypher, row = record_batch(record)
+            rows = pending.setdefault(cypher, [])
+            rows.append(row)
+            pending_count += 1
+            if len(rows) >= batch_size:
+                result, batch_runtime = self.write_transaction([(cypher, {'rows': rows})])
+                count += len(rows)
+                runtime += batch_runtime
+                pending_count -= len(rows)
+                del pending[cypher]
+            elif window is not None and pending_count >= window:
+                for cypher, rows in pending.items():
+                    result, batch_runtime = self.write_transaction([(cypher, {'rows': rows})])
+                    count += len(rows)
+                    runtime += batch_runtime
+                pending = {}
+                pending_count = 0
+        for cypher, rows in pending.items():
+            result, batch_runtime = self.write_transaction([(cypher, {'rows': rows})])
+            count += len(rows)
+            runtime += batch_runtime
+        return count, runtime
+
+    # Creates nodes from the records returned by resource_to_node(resource, as_records=True)
+    def create_nodes(self, records, batch_size=1000, window=None):
+        return self.write_batches(records, node_record_batch, batch_size, window)
+
+    # Creates or updates nodes from the records returned by resource_to_node(resource, as_records=True),
+    # matching existing nodes on id
+    def merge_nodes(self, records, batch_size=1000, window=None):
+        return self.write_batches(records, node_record_merge_batch, batch_size, window)
+
+    # Returns {id: content_hash} for the resources with the given ids that are in the graph
+    def resource_hashes(self, ids):
+        cypher = '''
+            UNWIND $ids AS id
+            MATCH (n:resource {id: id})
+            RETURN n.id, n.content_hash
+        '''
+        result, runtime = self.query(cypher, {'ids': ids})
+        return {row[0]: row[1] for row in result}
+
+    # Deletes the edges going out of the resources with the given ids, i.e. the edges created from their
+    # references and dates
+    def delete_edges(self, ids, batch_size=1000):
+        cypher = '''
+            UNWIND $rows AS id
+            MATCH (n:resource {id: id})-[r]->()
+            DELETE r
+        '''
+        return self.write_batches(ids, lambda id: (cypher, id), batch_size)
+
+    # Returns [id, text, embedding_hash] for up to limit resource nodes (or nodes with the given label, e.g. Chunk)
+    # with text and an id after the given one, in id order, so all the texts can be paged through using the
+    # uniqueness constraint on id
+    def resource_texts(self, after='', limit=1000, label='resource'):
         cypher = f'''
-            MATCH (r:resource) 
-            WITH DISTINCT(r.resource_type) AS resource_types
-                ORDER BY resource_types
-            UNWIND resource_types as resource_type
-            MATCH (r:resource)
-            WHERE r.resource_type = resource_type
-            WITH resource_type, COUNT(r) as resource_count
-            RETURN resource_type, resource_count
-                ORDER BY resource_count
+            MATCH (n:`{label}`)
+            WHERE n.id > $after AND n.text IS NOT NULL
+            RETURN n.id, n.text, n.embedding_hash
+            ORDER BY n.id
+            LIMIT $limit
         '''
+        result, runtime = self.query(cypher, {'after': after, 'limit': limit})
+        return result
+
+    # Sets the embedding (and the hash of the text and model it was made from) of resource nodes (or nodes with
+    # the given label), from rows of {id, embedding, embedding_hash}
+    def set_embeddings(self, rows, batch_size=500, label='resource'):
+        cypher = f'''
+            UNWIND $rows AS row
+            MATCH (n:`{label}` {{id: row.id}})
+            SET n.embedding = row.embedding, n.embedding_hash = row.embedding_hash
+        '''
+        return self.write_batches(rows, lambda row: (cypher, row), batch_size)
+
+    # Creates the vector index used by Neo4jVector over the embeddings of the resource nodes (or nodes with the
+    # given label)
+    def ensure_vector_index(self, dimensions, index_name='fhir_text', property_name='embedding',
+                            similarity_function='cosine', label='resource'):
+        cypher = f'''
+            CREATE VECTOR INDEX `{index_name}` IF NOT EXISTS
+            FOR (n:`{label}`) ON (n.`{property_name}`)
+            OPTIONS {{indexConfig: {{
+                `vector.dimensions`: {int(dimensions)},
+                `vector.similarity_function`: '{similarity_function}'
+            }}}}
+        '''
+        result, runtime = self.query(cypher)
+        return runtime
+
+    # Materializes the neighbor_context of every resource node (see neighbor_context_cypher), batch_size nodes at
+    # a time in id order. Run once the edges are loaded, retrieval then reads the property instead of traversing.
+    # Starts after the id after, and calls on_batch with the last id and the running count after each batch, so an
+    # interrupted run can be resumed from there. Returns the number of nodes updated and the runtime.
+    def materialize_neighbor_context(self, max_neighbors=10, max_length=4000, batch_size=1000, after='',
+                                     on_batch=None):
+        count = 0
+        runtime = 0
+        while True:
+            results, batch_runtime = self.write_transaction([(neighbor_context_page_cypher, {
+                'after': after, 'limit': batch_size, 'max_neighbors': max_neighbors, 'max_length': max_length
+            })])
+            runtime += batch_runtime
+            if len(results[0]) == 0 or results[0][0][0] is None:
+                return count, runtime
+            after = results[0][0][0]
+            count += results[0][0][1]
+            if on_batch is not None:
+                on_batch(after, count)
+
+    # Materializes the neighbor_context of the resources with the given ids and of the resources next to them,
+    # e.g. after an incremental load changed them. Returns the number of ids and the runtime.
+    def update_neighbor_context(self, ids, max_neighbors=10, max_length=4000, batch_size=1000):
+        cypher = '''
+            UNWIND $rows AS id
+            MATCH (changed:resource {id: id})
+            OPTIONAL MATCH (changed)--(neighbor:resource)
+            WITH collect(DISTINCT changed) + collect(DISTINCT neighbor) AS nodes
+            UNWIND nodes AS node
+            WITH DISTINCT node
+        ''' + neighbor_context_cypher
+        count = 0
+        runtime = 0
+        rows = []
+        for id in ids:
+            rows.append(id)
+            if len(rows) >= batch_size:
+                result, batch_runtime = self.write_transaction([(cypher, {
+                    'rows': rows, 'max_neighbors': max_neighbors, 'max_length': max_length
+                })])
+                count += len(rows)
+                runtime += batch_runtime
+                rows = []
+        if len(rows) > 0:
+            result, batch_runtime = self.write_transaction([(cypher, {
+                'rows': rows, 'max_neighbors': max_neighbors, 'max_length': max_length
+            })])
+            count += len(rows)
+            runtime += batch_runtime
+        return count, runtime
+
+    # Deletes the Chunk nodes (see FHIR_chunking) of all the resources, or only of the resources with the given ids,
+    # batch_size at a time. Returns the number of chunks deleted and the runtime.
+    def delete_chunks(self, ids=None, batch_size=10000):
+        if ids is None:
+            cypher = '''
+                MATCH (c:Chunk)
+                WITH c LIMIT $batch_size
+                DETACH DELETE c
+                RETURN COUNT(c)
+            '''
+            return self.delete_in_batches(cypher, batch_size)
+        cypher = '''
+            UNWIND $rows AS id
+            MATCH (c:Chunk)-[:chunk_of]->(:resource {id: id})
+            DETACH DELETE c
+        '''
+        return self.write_batches(ids, lambda id: (cypher, id), batch_size)
+
+    # Creates edges from the records returned by resource_to_edges(resource, as_records=True)
+    def create_edges(self, records, batch_size=1000, window=None):
+        return self.write_batches(records, edge_record_batch, batch_size, window)
+
+    # Creates or updates edges from the records returned by resource_to_edges(resource, as_records=True), without
+    # duplicating the ones already there
+    def merge_edges(self, records, batch_size=1000, window=None):
+        return self.write_batches(records, edge_record_merge_batch, batch_size, window)
+
+    # Creates the constraints and indexes needed for loading edges, and waits for them to come online.
+    # Should be run before loading, the uniqueness constraints can't be created over duplicated ids.
+    def ensure_schema(self, timeout=300):
+        runtime = 0
+        for cypher in schema_cypher:
+            result, statement_runtime = self.query(cypher)
+            runtime += statement_runtime
+        result, statement_runtime = self.query('CALL db.awaitIndexes($timeout)', {'timeout': timeout})
+        return runtime + statement_runtime
+
+    # Get type and number of each FHIR resource in the database.
+    # Every resource node has its resource type as a label, so the counts come from the count store.
+    def resource_metrics(self):
+        labels, runtime = self.query('CALL db.labels() YIELD label RETURN label ORDER BY label')
+        resource_types = [row[0] for row in labels if row[0] not in non_resource_labels]
+        if len(resource_types) == 0:
+            return []
+
+        cypher = ' UNION ALL '.join(
+            f"MATCH (r:`{resource_type}`) RETURN '{resource_type}' AS resource_type, COUNT(r) AS resource_count"
+            for resource_type in resource_types
+        )
 
         resource_count, runtime = self.query(cypher)
+        resource_count.sort(key=lambda row: row[1])
         return resource_count
 
 
-    # Standard metrics for counting nodes and relationships
+    # Standard metrics for counting nodes and relationships, both come from the count store
     def database_metrics(self):
         node_count = 0
         relationship_count = 0
 
-        cypher = f'''
-            MATCH (n) 
-            WITH COUNT(n) as node_count
-            MATCH ()-[r]->()
-            WITH node_count, COUNT(r) as relationship_count
+        cypher = '''
+            CALL {
+                MATCH (n)
+                RETURN COUNT(n) as node_count
+            }
+            CALL {
+                MATCH ()-[r]->()
+                RETURN COUNT(r) as relationship_count
+            }
             RETURN node_count, relationship_count
         '''
 
@@ -76,13 +425,112 @@ class Graph:
 
         return node_count, relationship_count
 
-    # Deletes all nodes and their relationships in database
-    def wipe_database(self):
+    # Runs a delete statement that returns how much it deleted until there is nothing left to delete,
+    # calling on_batch with the running total after each batch
+    def delete_in_batches(self, cypher, batch_size, on_batch=None):
+        deleted = 0
+        runtime = 0
+        while True:
+            delete_result, batch_runtime = self.query(cypher, {'batch_size': batch_size}, db_write_stage)
+            runtime += batch_runtime
+            if delete_result[0][0] == 0:
+                return deleted, runtime
+            deleted += delete_result[0][0]
+            if on_batch is not None:
+                on_batch(deleted)
+
+    # Deletes all nodes and their relationships in database. The relationships and then the nodes are deleted
+    # batch_size at a time, each batch in its own transaction, so the heap needed doesn't grow with the graph.
+    # If given, progress is called after each batch with the number of nodes and relationships deleted so far.
+    def wipe_database(self, batch_size=10000, progress=None):
         node_count, relationship_count = self.database_metrics()
 
-        cypher = f'''
-            MATCH (n) DETACH DELETE n
+        delete_relationships = '''
+            MATCH ()-[r]->()
+            WITH r LIMIT $batch_size
+            DELETE r
+            RETURN COUNT(r)
+        '''
+        delete_nodes = '''
+            MATCH (n)
+            WITH n LIMIT $batch_size
+            DETACH DELETE n
+            RETURN COUNT(n)
         '''
 
-        delete_result, runtime = self.query(cypher)
-        return 'Deleted {} nodes and {} relationships in {} seconds'.format( node_count, relationship_count, runtime )
\ No newline at end of file
+        relationship_progress = None
+        node_progress = None
+        if progress is not None:
+            relationship_progress = lambda deleted: progress(0, deleted)
+            node_progress = lambda deleted: progress(deleted, relationships_deleted)
+
+        relationships_deleted, relationship_runtime = self.delete_in_batches(delete_relationships, batch_size,
+                                                                             relationship_progress)
+        nodes_deleted, node_runtime = self.delete_in_batches(delete_nodes, batch_size, node_progress)
+        runtime = relationship_runtime + node_runtime
+
+        return 'Deleted {} nodes and {} relationships in {} seconds'.format( node_count, relationship_count, runtime )
+
+
+# Graph on the neo4j async driver, for loading with concurrent writers (see FHIR_async_pipeline). Only the writes
+# needed for loading are here, everything else is done with Graph.
+class AsyncGraph:
+    def __init__(self, url, username, password, max_connection_pool_size=100, max_transaction_retry_time=30.0,
+                 driver=None):
+        self._url = url
+        self._username = username
+        self._password = password
+        if driver is None:
+            driver = AsyncGraphDatabase.driver(url, auth=(username, password),
+                                               max_connection_pool_size=max_connection_pool_size,
+                                               max_transaction_retry_time=max_transaction_retry_time)
+        self._driver = driver
+
+    async def close(self):
+        await self._driver.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    # Same as Graph.write_transaction. The transaction is retried by the driver on transient errors, which
+    # include the deadlocks of concurrent writers locking the same nodes (e.g. a Patient all the edges point to).
+    async def write_transaction(self, statements):
+        async def run_statements(tx):
+            results = []
+            for statement in statements:
+                if type(statement) is tuple:
+                    cypher, parameters = statement
+                else:
+                    cypher, parameters = statement, None
+                result = await tx.run(cypher, parameters)
+                results.append([record.values() async for record in result])
+            return results
+
+        time = timer()
+        async with self._driver.session() as session:
+            results = await session.execute_write(run_statements)
+        runtime = time.end()
+        if metrics.enabled:
+            items = sum(statement_items(statement[1]) if type(statement) is tuple else 1 for statement in statements)
+            metrics.record(db_write_stage, runtime, items)
+        return results, runtime
+
+    # Same as Graph.materialize_neighbor_context
+    async def materialize_neighbor_context(self, max_neighbors=10, max_length=4000, batch_size=1000, after='',
+                                           on_batch=None):
+        count = 0
+        runtime = 0
+        while True:
+            results, batch_runtime = await self.write_transaction([(neighbor_context_page_cypher, {
+                'after': after, 'limit': batch_size, 'max_neighbors': max_neighbors, 'max_length': max_length
+            })])
+            runtime += batch_runtime
+            if len(results[0]) == 0 or results[0][0][0] is None:
+                return count, runtime
+            after = results[0][0][0]
+            count += results[0][0][1]
+            if on_batch is not None:
+                on_batch(after, count)